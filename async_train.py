@@ -0,0 +1,272 @@
+from collections import deque
+from sys import float_info
+import queue
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from dqn_agent import Agent, ReplayBuffer, get_network
+from vec_env import HeadlessBananaEnv, UnityVecEnv, STATE_SIZE, ACTION_SIZE
+from train import SCORE_WINDOW
+
+'''
+    Asynchronous training in the style of Ape-X, https://arxiv.org/pdf/1803.00933.pdf
+    Several actor processes step their own environments with epsilon-greedy copies of
+    qnetwork_local and write transitions into a replay buffer that lives in shared memory,
+    while the learner (the calling process) runs Agent.learn continuously and broadcasts
+    its weights to the actors every few updates.
+'''
+class SharedReplayBuffer(ReplayBuffer):
+    """Ring buffer whose storage, cursor and size live in shared memory, so that it can be
+    handed to other processes and written by several actors while the learner samples it."""
+
+    def __init__(self, action_size, buffer_size, batch_size, seed, state_size):
+        """Initialize a SharedReplayBuffer object.
+
+        Params
+        ======
+            action_size (int): dimension of each action
+            buffer_size (int): maximum size of buffer
+            batch_size (int): size of each training batch
+            seed (int): random seed
+            state_size (int): dimension of each state
+        """
+        # cursor and size
+        self.counters = torch.zeros(2, dtype=torch.int64).share_memory_()
+        self.lock = mp.get_context('spawn').Lock()
+        super().__init__(action_size, buffer_size, batch_size, seed, state_size=state_size, pin_memory=False)
+
+    def _allocate(self, state_size):
+        self.state_size = state_size
+        self.tensors = (
+            torch.zeros((self.buffer_size, state_size), dtype=torch.float32).share_memory_(),
+            torch.zeros((self.buffer_size, 1), dtype=torch.int64).share_memory_(),
+            torch.zeros((self.buffer_size, 1), dtype=torch.float32).share_memory_(),
+            torch.zeros((self.buffer_size, state_size), dtype=torch.float32).share_memory_(),
+            torch.zeros((self.buffer_size, 1), dtype=torch.float32).share_memory_(),
+        )
+        # float32 storage, gathered as it is stored
+        self._decoded = True
+        self._staging = None
+        self._copy_event = None
+        self._bind()
+
+    def _bind(self):
+        """Point the numpy storage used by ReplayBuffer at the shared tensors."""
+        self.states, self.actions, self.rewards, self.next_states, self.dones = (t.numpy() for t in self.tensors)
+
+    def __getstate__(self):
+        # the numpy views would be pickled by value, only send the shared tensors
+        state = self.__dict__.copy()
+        for name in ('states', 'actions', 'rewards', 'next_states', 'dones'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._bind()
+
+    @property
+    def cursor(self):
+        return int(self.counters[0])
+
+    @cursor.setter
+    def cursor(self, value):
+        self.counters[0] = value
+
+    @property
+    def size(self):
+        return int(self.counters[1])
+
+    @size.setter
+    def size(self, value):
+        self.counters[1] = value
+
+    def add_batch(self, states, actions, rewards, next_states, dones):
+        with self.lock:
+            return super().add_batch(states, actions, rewards, next_states, dones)
+
+    def add(self, state, action, reward, next_state, done):
+        self.add_batch([state], [action], [reward], [next_state], [done])
+
+    def sample(self):
+        with self.lock:
+            return super().sample()
+
+
+def actor_epsilons(num_actors, base_eps=0.4, alpha=7.):
+    '''
+        Fixed exploration rate of each actor, eps_i = base_eps^(1 + i/(N-1) * alpha) as in Ape-X.
+    '''
+    if num_actors == 1:
+        return [base_eps]
+    return [base_eps ** (1 + i / (num_actors - 1) * alpha) for i in range(num_actors)]
+
+
+def _actor(actor_id, config, env_type, num_envs, file_name, eps, memory, weights, weights_version,
+        actor_steps, scores_queue, stop_event, flush_size):
+    '''
+        Actor process: step the environment with an epsilon-greedy copy of the learner's network,
+        and flush the transitions to the shared replay buffer flush_size at a time.
+    '''
+    # the learner owns the cores, an actor only needs one thread for its small forward passes
+    torch.set_num_threads(1)
+    rng = np.random.RandomState(actor_id)
+    torch.manual_seed(actor_id)
+    if env_type == 'headless':
+        env = HeadlessBananaEnv(num_envs=num_envs, seed=actor_id)
+    else:
+        env = UnityVecEnv(file_name, num_envs, base_worker_id=actor_id * num_envs)
+
+    network = get_network(config['is_dueling'] if 'is_dueling' in config else False)(memory.state_size, memory.action_size)
+    network.eval()
+    version = -1
+    pending = []
+    while not stop_event.is_set():
+        states = env.reset(train_mode=True)
+        episode_scores = np.zeros(num_envs)
+        active = np.ones(num_envs, dtype=bool)
+        for _ in range(config['max_time']):
+            # pick up the latest weights broadcast by the learner, without locking : like in
+            # Ape-X an actor acting on a slightly mixed set of weights is harmless
+            if int(weights_version) != version:
+                version = int(weights_version)
+                torch.nn.utils.vector_to_parameters(weights, network.parameters())
+
+            with torch.no_grad():
+                actions = network(torch.from_numpy(states).float()).argmax(1).numpy()
+            explore = rng.random_sample(num_envs) < eps
+            actions[explore] = rng.randint(memory.action_size, size=int(explore.sum()))
+
+            next_states, rewards, dones = env.step(actions)
+            pending.append((states[active], actions[active], rewards[active], next_states[active], dones[active]))
+            actor_steps[actor_id] += int(active.sum())
+            if len(pending) * num_envs >= flush_size:
+                memory.add_batch(*(np.concatenate(field) for field in zip(*pending)))
+                pending = []
+
+            episode_scores += rewards * active
+            active &= ~dones
+            states = next_states
+            if not active.any() or stop_event.is_set():
+                break
+        for score in episode_scores:
+            scores_queue.put((actor_id, float(score)))
+    env.close()
+
+
+def run_async(config, num_actors, save_name, file_name=None, broadcast_every=50, flush_size=64, report_every=10.):
+    '''
+        Train an agent with num_actors actor processes feeding one learner, until the actors
+        have played config['num_episodes'] episodes in total.
+    Params
+    ======
+        config (dict): training configuration, see train.dqn
+        num_actors (int): number of actor processes
+        save_name (str): file name of the saved network, written each time the rolling mean improves
+        file_name (str): path to the Unity executable, unused for the headless environment
+        broadcast_every (int): number of learner updates between weight broadcasts
+        flush_size (int): number of transitions an actor gathers before writing them to the buffer
+        report_every (float): seconds between throughput reports
+    return the episode scores and the actor and learner throughput
+    '''
+    if config['prioritized_replay']:
+        raise Exception('Asynchronous training samples the shared replay buffer uniformly, prioritized_replay is not supported')
+    if 'replay_dir' in config and config['replay_dir']:
+        raise Exception('Asynchronous training keeps the replay buffer in shared memory, replay_dir is not supported')
+    if 'record_dir' in config and config['record_dir']:
+        raise Exception('Asynchronous training steps the environments in the actor processes, record_dir is not supported')
+
+    env_type = config['env'] if 'env' in config else 'unity'
+    num_envs = config['num_envs'] if 'num_envs' in config else 1
+    if env_type == 'headless':
+        state_size, action_size = STATE_SIZE, ACTION_SIZE
+    else:
+        probe = UnityVecEnv(file_name, 1, base_worker_id=num_actors * num_envs)
+        state_size, action_size = probe.reset(train_mode=True).shape[1], probe.action_size
+        probe.close()
+
+    # the agent's own replay buffer is replaced by the shared one, which is warm started instead
+    agent = Agent(state_size=state_size, action_size=action_size, seed=0, config=dict(config, replay_warm_start=None))
+    memory = SharedReplayBuffer(action_size, config['replay_buffer_size'], config['batch_size'], 0, state_size)
+    if 'replay_warm_start' in config and config['replay_warm_start']:
+        memory.warm_start(config['replay_warm_start'])
+    agent.memory = memory
+
+    weights = torch.nn.utils.parameters_to_vector(agent.qnetwork_local.parameters()).detach().cpu().share_memory_()
+    weights_version = torch.zeros(1, dtype=torch.int64).share_memory_()
+    actor_steps = torch.zeros(num_actors, dtype=torch.int64).share_memory_()
+
+    context = mp.get_context('spawn')
+    scores_queue = context.Queue()
+    stop_event = context.Event()
+    actors = [context.Process(target=_actor, args=(i, config, env_type, num_envs, file_name, eps, memory, weights,
+            weights_version, actor_steps, scores_queue, stop_event, flush_size), daemon=True)
+        for i, eps in enumerate(actor_epsilons(num_actors))]
+    for actor in actors:
+        actor.start()
+
+    scores = []
+    scores_window = deque(maxlen=SCORE_WINDOW)
+    max_score = float_info.min
+    updates = 0
+    start = last_report = time.time()
+    try:
+        while len(scores) < config['num_episodes']:
+            # collect the finished episodes
+            num_scores = len(scores)
+            try:
+                while True:
+                    _, score = scores_queue.get_nowait()
+                    scores.append(score)
+                    scores_window.append(score)
+            except queue.Empty:
+                pass
+            # actors only stop when told to, one that exited will never send the scores the loop waits for
+            for i, actor in enumerate(actors):
+                if actor.exitcode is not None:
+                    raise Exception('Actor {} exited with code {} after {} episodes'.format(i, actor.exitcode, len(scores)))
+
+            if len(scores) > num_scores and np.mean(scores_window) > max_score:
+                max_score = np.mean(scores_window)
+                torch.save({
+                        'net': agent.qnetwork_local.state_dict(),
+                        'config': config,
+                        'scores': scores,
+                    },
+                    save_name)
+
+            if len(memory) > config['batch_size']:
+                experiences, random_indices = memory.sample()
+                agent.learn(experiences, random_indices, config['gamma'])
+                updates += 1
+                if updates % broadcast_every == 0:
+                    weights.copy_(torch.nn.utils.parameters_to_vector(agent.qnetwork_local.parameters()).detach())
+                    weights_version += 1
+            else:
+                time.sleep(0.01)
+
+            now = time.time()
+            if now - last_report > report_every:
+                last_report = now
+                elapsed = now - start
+                print('\rEpisode {}\tAverage Score: {:.2f}\tActor steps/s: {:.0f}\tLearner updates/s: {:.0f}'.format(
+                    len(scores), np.mean(scores_window) if scores_window else 0., int(actor_steps.sum()) / elapsed,
+                    updates / elapsed))
+    finally:
+        stop_event.set()
+        for actor in actors:
+            actor.join(timeout=10)
+            if actor.is_alive():
+                actor.terminate()
+
+    elapsed = time.time() - start
+    throughput = {
+        'seconds': elapsed,
+        'actor_steps_per_second': [int(steps) / elapsed for steps in actor_steps],
+        'total_actor_steps_per_second': int(actor_steps.sum()) / elapsed,
+        'learner_updates_per_second': updates / elapsed,
+    }
+    print('\nActor steps/s {:.0f} ({}), learner updates/s {:.0f}'.format(throughput['total_actor_steps_per_second'],
+        ', '.join('{:.0f}'.format(s) for s in throughput['actor_steps_per_second']), throughput['learner_updates_per_second']))
+    return scores, throughput
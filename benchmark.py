@@ -0,0 +1,269 @@
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+import numpy as np
+import torch
+from dqn_agent import Agent, ReplayBuffer, PrioritizedReplayBuffer, device
+from cpu_mode import available_cores, scale_batch
+from vec_env import HeadlessBananaEnv, STATE_SIZE, ACTION_SIZE
+import train
+
+'''
+    Performance benchmarks, runnable on a headless cpu-only machine.
+    Every benchmark reports a rate (operations per second, higher is better) and the
+    results are written to a json file, which can be compared against a stored baseline :
+        python benchmark.py --output results.json
+        python benchmark.py --output results.json --baseline baseline.json
+'''
+BASE_CONFIG = {
+    "is_dueling": False,
+    "double_dqn": False,
+    "prioritized_replay": False,
+    "replay_buffer_size": 1e5,
+    "batch_size": 64,
+    "gamma": 0.99,
+    "tau": 1e-3,
+    "learning_rate": 1e-4,
+    "learn_every": 4,
+    "num_episodes": 1,
+    "max_time": 1000,
+    "eps_start": 1.0,
+    "eps_end": 0.01,
+    "eps_decay": 0.995,
+    "alpha": 0.5,
+    "beta": 0.5,
+}
+
+def measure(fn, ops_per_call, min_time, repeats=3):
+    '''
+        Call fn repeatedly for at least min_time seconds, repeats times, and return
+        the best rate in operations per second along with the median.
+    '''
+    rates = []
+    for _ in range(repeats):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            fn()
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        rates.append(calls * ops_per_call / elapsed)
+    return {'rate': max(rates), 'median_rate': float(np.median(rates))}
+
+
+def random_transitions(rng, n):
+    return (rng.rand(n, STATE_SIZE), rng.randint(ACTION_SIZE, size=n), rng.rand(n).astype(np.float32),
+        rng.rand(n, STATE_SIZE), rng.rand(n) < 0.01)
+
+
+def filled_buffer(buffer_size, batch_size, prioritized, rng, **storage):
+    if prioritized:
+        memory = PrioritizedReplayBuffer(ACTION_SIZE, buffer_size, batch_size, 0, BASE_CONFIG['alpha'], state_size=STATE_SIZE, **storage)
+    else:
+        memory = ReplayBuffer(ACTION_SIZE, buffer_size, batch_size, 0, state_size=STATE_SIZE, **storage)
+    chunk = 10000
+    for _ in range(0, int(buffer_size), chunk):
+        memory.add_batch(*random_transitions(rng, chunk))
+    return memory
+
+
+def bench_replay(buffer_sizes, min_time):
+    results = {}
+    rng = np.random.RandomState(0)
+    state, action, reward, next_state, done = (field[0] for field in random_transitions(rng, 1))
+    # random transitions never continue each other, so the compact buffers store both observations,
+    # which is their worst case for the time and the space
+    variants = [
+        ('uniform', False, {}),
+        ('per', True, {}),
+        ('uniform_compact_float16', False, {'compact': True, 'obs_dtype': 'float16'}),
+    ]
+    for buffer_size in buffer_sizes:
+        for variant, prioritized, storage in variants:
+            memory = filled_buffer(buffer_size, BASE_CONFIG['batch_size'], prioritized, rng, **storage)
+            name = 'replay/{}/{}'.format(variant, int(buffer_size))
+            results[name + '/add'] = measure(lambda: memory.add(state, action, reward, next_state, done), 1, min_time)
+            results[name + '/add']['bytes_per_transition'] = memory.nbytes() / memory.buffer_size
+            if prioritized:
+                sample = lambda: memory.sample(BASE_CONFIG['beta'])
+            else:
+                sample = memory.sample
+            results[name + '/sample'] = measure(sample, 1, min_time)
+            if prioritized:
+                indices = np.arange(BASE_CONFIG['batch_size'])
+                errors = rng.rand(BASE_CONFIG['batch_size'])
+                results[name + '/update_priorities'] = measure(lambda: memory.update_priorities(indices, errors), 1, min_time)
+    return results
+
+
+def bench_learn(min_time):
+    results = {}
+    rng = np.random.RandomState(0)
+    for is_dueling in (False, True):
+        for double_dqn in (False, True):
+            for prioritized in (False, True):
+                config = dict(BASE_CONFIG, is_dueling=is_dueling, double_dqn=double_dqn, prioritized_replay=prioritized)
+                agent = Agent(STATE_SIZE, ACTION_SIZE, 0, config)
+                agent.memory.add_batch(*random_transitions(rng, 10000))
+                name = 'learn/{}{}{}'.format('DuelingQNetwork' if is_dueling else 'QNetwork',
+                    '/double_dqn' if double_dqn else '', '/per' if prioritized else '')
+                # sampling included, as in Agent.step
+                results[name] = measure(agent.learn_from_memory, 1, min_time)
+                agent.close()
+    return results
+
+
+def bench_act(batch_sizes, min_time):
+    results = {}
+    rng = np.random.RandomState(0)
+    for is_dueling in (False, True):
+        agent = Agent(STATE_SIZE, ACTION_SIZE, 0, dict(BASE_CONFIG, is_dueling=is_dueling, replay_buffer_size=1000))
+        network = 'DuelingQNetwork' if is_dueling else 'QNetwork'
+        for batch_size in batch_sizes:
+            states = rng.rand(batch_size, STATE_SIZE) if batch_size > 1 else rng.rand(STATE_SIZE)
+            result = measure(lambda: agent.act(states, 0.), 1, min_time)
+            result['latency_us'] = 1e6 / result['rate']
+            results['act/{}/{}'.format(network, batch_size)] = result
+    return results
+
+
+def bench_end_to_end(num_envs_list, num_episodes):
+    '''
+        Environment steps per second of train.dqn_vec against the headless environment,
+        including acting, replay and learning.
+    '''
+    results = {}
+    for num_envs in num_envs_list:
+        config = dict(BASE_CONFIG, num_episodes=num_episodes * num_envs)
+        env = HeadlessBananaEnv(num_envs=num_envs, seed=0)
+        agent = Agent(STATE_SIZE, ACTION_SIZE, 0, config)
+        with tempfile.TemporaryDirectory() as directory:
+            start = time.perf_counter()
+            train.dqn_vec(config, env, agent, os.path.join(directory, 'benchmark.pth'))
+            elapsed = time.perf_counter() - start
+        agent.close()
+        steps = num_episodes * num_envs * env.max_steps
+        results['end_to_end/headless/{}'.format(num_envs)] = {'rate': steps / elapsed, 'median_rate': steps / elapsed}
+    print()
+    return results
+
+
+def bench_cpu(min_time, num_episodes):
+    '''
+        Transitions replayed per second by Agent.learn in the cpu modes of cpu_mode.py, with the gain
+        over the default settings, and the environment steps per second of train.dqn_vec in each mode.
+    '''
+    results = {}
+    rng = np.random.RandomState(0)
+    default_threads = torch.get_num_threads()
+    variants = [('default', default_threads, {})]
+    variants += [('threads_{}'.format(n), n, {}) for n in sorted({1, 2, len(available_cores())}) if n != default_threads]
+    variants.append(('batch_scale_4', default_threads, {'batch_scale': 4}))
+    if hasattr(torch, 'autocast') and device.type == 'cpu':
+        variants.append(('bf16_autocast', default_threads, {'bf16_autocast': True}))
+        variants.append(('bf16_autocast/batch_scale_4', default_threads, {'bf16_autocast': True, 'batch_scale': 4}))
+    for variant, threads, options in variants:
+        torch.set_num_threads(threads)
+        config = scale_batch(dict(BASE_CONFIG, **options))
+        agent = Agent(STATE_SIZE, ACTION_SIZE, 0, config)
+        agent.memory.add_batch(*random_transitions(rng, 10000))
+        name = 'cpu/learn/{}'.format(variant)
+        results[name] = measure(agent.learn_from_memory, config['batch_size'], min_time)
+        agent.close()
+
+        env = HeadlessBananaEnv(num_envs=8, seed=0)
+        config = dict(config, num_episodes=num_episodes * 8)
+        agent = Agent(STATE_SIZE, ACTION_SIZE, 0, config)
+        with tempfile.TemporaryDirectory() as directory:
+            start = time.perf_counter()
+            train.dqn_vec(config, env, agent, os.path.join(directory, 'benchmark.pth'))
+            elapsed = time.perf_counter() - start
+        agent.close()
+        steps = num_episodes * 8 * env.max_steps
+        results['cpu/end_to_end/{}'.format(variant)] = {'rate': steps / elapsed, 'median_rate': steps / elapsed}
+    torch.set_num_threads(default_threads)
+    print()
+    for phase in ('learn', 'end_to_end'):
+        default = results['cpu/{}/default'.format(phase)]['rate']
+        for variant, _, _ in variants:
+            result = results['cpu/{}/{}'.format(phase, variant)]
+            result['speedup'] = result['rate'] / default
+            print('{:<50} {:>14.1f} {:>8.2f}x'.format('cpu/{}/{}'.format(phase, variant), result['rate'], result['speedup']))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''
+        Relative change of every rate against the baseline.
+        return the names of the benchmarks slower than the baseline by more than tolerance
+    '''
+    regressions = []
+    print('\n{:<50} {:>14} {:>14} {:>9}'.format('benchmark', 'baseline', 'current', 'change'))
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        before = baseline[name]['rate']
+        change = result['rate'] / before - 1.
+        flag = ''
+        if change < -tolerance:
+            regressions.append(name)
+            flag = ' <-- regression'
+        print('{:<50} {:>14.1f} {:>14.1f} {:>+8.1%}{}'.format(name, before, result['rate'], change, flag))
+    return regressions
+
+
+parser = argparse.ArgumentParser(description="Benchmark the replay memory, learning, acting and training loop")
+parser.add_argument('--output', default='benchmark.json', help="Json file the results are written to.")
+parser.add_argument('--baseline', help="Json file of previous results to compare against.")
+parser.add_argument('--tolerance', type=float, default=0.1, help="Relative slowdown reported as a regression.")
+parser.add_argument('--min-time', type=float, default=0.5, help="Seconds spent measuring each repetition.")
+parser.add_argument('--quick', action='store_true', help="Skip the largest replay buffer and shorten the end to end run.")
+parser.add_argument('--only', nargs='*', choices=['replay', 'learn', 'act', 'end_to_end', 'cpu'], help="Run only these groups.")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    # read before the results are written, which replace it when --output is the same file
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    groups = set(args.only) if args.only else {'replay', 'learn', 'act', 'end_to_end', 'cpu'}
+
+    results = {}
+    if 'replay' in groups:
+        results.update(bench_replay([1e4, 1e5] if args.quick else [1e4, 1e5, 1e6], args.min_time))
+    if 'learn' in groups:
+        results.update(bench_learn(args.min_time))
+    if 'act' in groups:
+        results.update(bench_act([1, 8, 64], args.min_time))
+    if 'end_to_end' in groups:
+        results.update(bench_end_to_end([1, 8], 1 if args.quick else 3))
+    if 'cpu' in groups:
+        results.update(bench_cpu(args.min_time, 1 if args.quick else 3))
+
+    report = {
+        'machine': {
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'numpy': np.__version__,
+            'device': str(device),
+            'torch_threads': torch.get_num_threads(),
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4, sort_keys=True)
+    print('Results written to {}'.format(args.output))
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('\n{} regression(s) beyond {:.0%}'.format(len(regressions), args.tolerance))
+            raise SystemExit(1)
@@ -0,0 +1,226 @@
+import os
+import queue
+import threading
+import numpy as np
+import torch
+import checkpoint_format
+from history import HistoryWriter, read_history
+
+'''
+    Checkpoints written off the training thread.
+    The training loop only snapshots the tensors to save (a copy on the cpu) and queues
+    them, a background thread serializes them to a temporary file and renames it into
+    place, so a checkpoint on disk is always complete.
+
+    For a save_name of model.pth the files are :
+        model.pth                the best network so far, loadable by navigator.py as before
+        model_ep<N>.pth          the keep_top_k best networks, when keep_top_k > 1
+        model_latest.pth         the latest state, written every checkpoint_every episodes,
+                                 with the optimizer and replay memory if save_training_state
+        model.hist               the record of every episode, see history.py, from which a resumed run
+                                 gets its scores back
+        model.ckpt               the best network in the format of checkpoint_format.py, if compact_checkpoint,
+                                 indexed in the ckpt_index.json of its directory
+'''
+def _snapshot(value):
+    '''
+        Copy every tensor (and numpy array) of a nested structure, so that training can
+        keep modifying the originals while the copy is being written.  Numpy arrays and
+        scalars become tensors and python numbers, which torch.load reads without
+        unpickling numpy objects (refused by default since torch 2.6).
+    '''
+    if torch.is_tensor(value):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, np.ndarray):
+        return torch.from_numpy(np.array(value))
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return {k: _snapshot(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_snapshot(v) for v in value)
+    return value
+
+
+def load_scores(file_name):
+    '''
+        Episode scores of a run, from its checkpoint for the runs that stored them there,
+        otherwise from the run history written next to it.
+    '''
+    network_info = torch.load(file_name, map_location='cpu')
+    if 'scores' in network_info:
+        return network_info['scores']
+    return read_scores(history_path(file_name, network_info))
+
+
+def history_path(file_name, network_info):
+    '''
+        Run history of a checkpoint, which names it relative to its own directory.
+    '''
+    return os.path.join(os.path.dirname(file_name), network_info['history_file'])
+
+
+def read_scores(history_file, max_episode=None):
+    '''
+        Scores of the episodes of a run history up to max_episode, all of them when None.
+    '''
+    if not os.path.exists(history_file):
+        raise Exception('The run history {} of the checkpoint is missing'.format(history_file))
+    history = read_history(history_file, ['score'])
+    played = history['episode'] <= max_episode if max_episode is not None else slice(None)
+    return [float(score) for score in history['score'][played]]
+
+
+class CheckpointWriter:
+    def __init__(self, save_name, config, keep_top_k=1, checkpoint_every=0, save_training_state=False, compact_checkpoint=False):
+        '''
+        Params
+        ======
+            save_name (str): file name of the best network
+            config (dict): training configuration, stored in every checkpoint
+            keep_top_k (int): number of best networks kept, in addition to save_name when larger than 1
+            checkpoint_every (int): episodes between two saves of the latest state, 0 to disable
+            save_training_state (bool): include the optimizer, target network and replay memory
+                in the latest state, so that an interrupted run can resume
+            compact_checkpoint (bool): also write the best network to a .ckpt file, and index it
+        '''
+        self.save_name = save_name
+        self.config = config
+        self.keep_top_k = keep_top_k
+        self.checkpoint_every = checkpoint_every
+        self.save_training_state = save_training_state
+        self.compact_checkpoint = compact_checkpoint
+        stem, _ = os.path.splitext(save_name)
+        self.ckpt_name = stem + '.ckpt'
+        self.latest_name = '{}_latest.pth'.format(stem)
+        self.history_file = stem + '.hist'
+        self.history = None
+        self.episode_name = stem + '_ep{}.pth'
+        # (mean score, file name) of the kept networks, best first
+        self.top_k = []
+        self.latest_episode = 0
+
+        self.jobs = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            try:
+                job()
+            except Exception as e:
+                # raised on the training thread by the next call
+                self.error = e
+
+    def _submit(self, job):
+        if self.error is not None:
+            raise self.error
+        self.jobs.put(job)
+
+    def _write(self, checkpoint, file_name):
+        def job():
+            temporary = file_name + '.tmp'
+            torch.save(checkpoint, temporary)
+            os.replace(temporary, file_name)
+        self._submit(job)
+
+    def start(self, resume_episode=None):
+        '''
+            Start the run history, appending to the one of the resumed run when resume_episode is given.
+        '''
+        self.history = HistoryWriter(self.history_file, self.config, resume_episode=resume_episode)
+
+    def append_episode(self, **record):
+        '''
+            Add the record of an episode to the run history, see history.COLUMNS.
+        '''
+        self.history.append(**record)
+
+    def _network_checkpoint(self, agent, i_episode, mean_score):
+        return {
+            'net': _snapshot(agent.qnetwork_local.state_dict()),
+            'config': self.config,
+            'episode': i_episode,
+            'mean_score': float(mean_score),
+            'history_file': os.path.basename(self.history_file),
+        }
+
+    def save_best(self, agent, i_episode, mean_score):
+        '''
+            Save a network that reached a new best rolling mean score.
+        '''
+        checkpoint = self._network_checkpoint(agent, i_episode, mean_score)
+        self._write(checkpoint, self.save_name)
+        if self.compact_checkpoint:
+            def job():
+                checkpoint_format.save_network(self.ckpt_name, checkpoint['net'], self.config, i_episode, mean_score,
+                    history_file=os.path.basename(self.history_file))
+                checkpoint_format.update_index(os.path.dirname(os.path.abspath(self.ckpt_name)))
+            self._submit(job)
+        if self.keep_top_k > 1:
+            file_name = self.episode_name.format(i_episode)
+            self._write(checkpoint, file_name)
+            self.top_k.append((float(mean_score), file_name))
+            self.top_k.sort(key=lambda kept: kept[0], reverse=True)
+            for _, dropped in self.top_k[self.keep_top_k:]:
+                self._submit(lambda dropped=dropped: os.remove(dropped) if os.path.exists(dropped) else None)
+            self.top_k = self.top_k[:self.keep_top_k]
+
+    def save_latest(self, agent, i_episode, mean_score, max_score, eps, force=False):
+        '''
+            Save the latest state every checkpoint_every episodes, or now if force
+            (at the end of training), nothing is saved when checkpoint_every is 0.
+        '''
+        if self.checkpoint_every <= 0 or (not force and i_episode - self.latest_episode < self.checkpoint_every):
+            return
+        self.latest_episode = i_episode
+        # a run resumed from this checkpoint reads its scores back from the history
+        self.history.flush()
+        checkpoint = self._network_checkpoint(agent, i_episode, mean_score)
+        checkpoint['eps'] = eps
+        checkpoint['max_score'] = float(max_score)
+        checkpoint['top_k'] = list(self.top_k)
+        if self.save_training_state:
+            checkpoint['target_net'] = _snapshot(agent.qnetwork_target.state_dict())
+            checkpoint['optimizer'] = _snapshot(agent.optimizer.state_dict())
+            checkpoint['t_step'] = agent.t_step
+            checkpoint['memory'] = _snapshot(agent.memory.state_dict())
+        self._write(checkpoint, self.latest_name)
+
+    def resume(self, agent):
+        '''
+            Restore the agent from the latest state, if there is one.
+            return the episode it was saved at, its epsilon, its best rolling mean score and the
+                scores up to that episode, or None when there is nothing to resume from
+        '''
+        if not os.path.exists(self.latest_name):
+            return None
+        checkpoint = torch.load(self.latest_name, map_location='cpu')
+        agent.qnetwork_local.load_state_dict(checkpoint['net'])
+        if 'target_net' in checkpoint:
+            agent.qnetwork_target.load_state_dict(checkpoint['target_net'])
+            agent.optimizer.load_state_dict(checkpoint['optimizer'])
+            agent.t_step = checkpoint['t_step']
+            agent.memory.load_state_dict(checkpoint['memory'])
+        else:
+            agent.qnetwork_target.load_state_dict(checkpoint['net'])
+        self.top_k = [tuple(kept) for kept in checkpoint['top_k']]
+        self.latest_episode = checkpoint['episode']
+        scores = read_scores(history_path(self.latest_name, checkpoint), max_episode=checkpoint['episode'])
+        print('Resuming from episode {} of {}'.format(checkpoint['episode'], self.latest_name))
+        return checkpoint['episode'], checkpoint['eps'], checkpoint['max_score'], scores
+
+    def close(self):
+        '''
+            Write the rest of the run history, and wait for every queued write to finish.
+        '''
+        if self.history is not None:
+            self.history.close()
+        self.jobs.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
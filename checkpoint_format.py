@@ -0,0 +1,290 @@
+import argparse
+import glob
+import json
+import os
+import time
+import numpy as np
+
+'''
+    Checkpoint files that can be inspected without torch, and an index of them across runs.
+
+    A .ckpt file is made of
+        8 bytes      MAGIC
+        8 bytes      length of the header, little endian
+        header       json : format version, network class, config, episode, mean score, ...
+                     and the dtype, shape and offset of every tensor
+        data         the raw tensors, each starting on a multiple of ALIGNMENT bytes
+    so listing runs only reads the headers, and the weights are memory mapped in place.
+
+    Every directory holding .ckpt files can have an index, ckpt_index.json, with the header of
+    each file (without its tensors).  It is refreshed from the headers of the files that changed
+    since it was written, so queries across hundreds of runs do not open any weights :
+        python checkpoint_format.py convert *.pth
+        python checkpoint_format.py query . --where gamma=0.99 --top 5
+'''
+MAGIC = b'NAVCKPT\x00'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+INDEX_FILE = 'ckpt_index.json'
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def network_name(tensor_names):
+    '''
+        Class of the network whose state dict has these keys.
+    '''
+    return 'DuelingQNetwork' if any(name.startswith('value_net.') for name in tensor_names) else 'QNetwork'
+
+
+def write_checkpoint(file_name, tensors, **meta):
+    '''
+        Write a .ckpt file, through a temporary file so that it is never seen half written.
+    Params
+    ======
+        file_name (str): output file
+        tensors (dict): name -> numpy array
+        meta: values stored in the header, like network, config, episode or mean_score
+    '''
+    arrays = {name: np.ascontiguousarray(array) for name, array in tensors.items()}
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _align(offset + array.nbytes)
+    header = dict(meta, format_version=FORMAT_VERSION, tensors=layout)
+    encoded = json.dumps(header).encode('utf-8')
+    data_start = _align(len(MAGIC) + 8 + len(encoded))
+
+    temporary = file_name + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(MAGIC)
+        f.write(len(encoded).to_bytes(8, 'little'))
+        f.write(encoded)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(array.tobytes())
+    os.replace(temporary, file_name)
+
+
+def _read_header(f, file_name):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise Exception('{} is not a .ckpt checkpoint'.format(file_name))
+    length = int.from_bytes(f.read(8), 'little')
+    header = json.loads(f.read(length).decode('utf-8'))
+    if header['format_version'] != FORMAT_VERSION:
+        raise Exception('Unsupported checkpoint format version {} in {}'.format(header['format_version'], file_name))
+    header['data_start'] = _align(len(MAGIC) + 8 + length)
+    return header
+
+
+def read_header(file_name):
+    '''
+        Header of a .ckpt file, without reading its tensors.
+    '''
+    with open(file_name, 'rb') as f:
+        return _read_header(f, file_name)
+
+
+def load_arrays(file_name, header=None):
+    '''
+        Tensors of a .ckpt file, as read-only numpy arrays memory mapped from the file.
+    '''
+    header = read_header(file_name) if header is None else header
+    arrays = {}
+    for name, tensor in header['tensors'].items():
+        shape = tuple(tensor['shape'])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape, dtype=np.dtype(tensor['dtype']))
+            continue
+        arrays[name] = np.memmap(file_name, dtype=np.dtype(tensor['dtype']), mode='r',
+            offset=header['data_start'] + tensor['offset'], shape=shape)
+    return arrays
+
+
+def load_network(file_name):
+    '''
+        A .ckpt file as the dictionary saved by train.dqn, {'net': state dict, 'config': ..., ...},
+        so that it can be used wherever a .pth checkpoint is loaded.
+    '''
+    import torch
+    header = read_header(file_name)
+    arrays = load_arrays(file_name, header)
+    network_info = {k: v for k, v in header.items() if k not in ('tensors', 'data_start', 'format_version')}
+    # copied out of the read-only memory map, torch tensors must be writable
+    network_info['net'] = {name[len('net.'):]: torch.from_numpy(np.array(array))
+        for name, array in arrays.items() if name.startswith('net.')}
+    if 'scores' in arrays:
+        network_info['scores'] = arrays['scores'].tolist()
+    return network_info
+
+
+def save_network(file_name, state_dict, config, episode, mean_score, **meta):
+    '''
+        Write the network of a checkpoint, a torch state dict, as a .ckpt file.
+    '''
+    tensors = {'net.' + name: tensor.detach().cpu().numpy() for name, tensor in state_dict.items()}
+    write_checkpoint(file_name, tensors, network=network_name(state_dict), config=config, episode=episode,
+        mean_score=float(mean_score), **meta)
+
+
+def rolling_means(scores, window=100):
+    '''
+        Mean of the last window scores after each episode, as computed during training.
+    '''
+    scores = np.asarray(scores, dtype=np.float64)
+    if len(scores) == 0:
+        return scores
+    sums = np.cumsum(np.concatenate([[0.], scores]))
+    counts = np.minimum(np.arange(1, len(scores) + 1), window)
+    return (sums[1:] - sums[np.arange(1, len(scores) + 1) - counts]) / counts
+
+
+def convert(pth_file, ckpt_file=None):
+    '''
+        Convert a .pth checkpoint to a .ckpt file next to it, or to ckpt_file.
+        The scores of the older checkpoints are kept as a tensor, and summarized in the header.
+    '''
+    import torch
+    from checkpoint import read_scores, history_path
+    ckpt_file = ckpt_file if ckpt_file is not None else os.path.splitext(pth_file)[0] + '.ckpt'
+    network_info = torch.load(pth_file, map_location='cpu')
+    if 'scores' in network_info:
+        scores = network_info['scores']
+    else:
+        scores = read_scores(history_path(pth_file, network_info))
+    means = rolling_means(scores)
+    meta = {k: v for k, v in network_info.items() if k not in ('net', 'config', 'scores', 'episode', 'mean_score')
+        and isinstance(v, (int, float, str, bool))}
+    # the older checkpoints hold the network of the best rolling mean, at the end of their scores
+    episode = network_info['episode'] if 'episode' in network_info else (int(np.argmax(means)) + 1 if len(means) else 0)
+    mean_score = network_info['mean_score'] if 'mean_score' in network_info else (float(means.max()) if len(means) else 0.)
+    tensors = {'net.' + name: tensor.numpy() for name, tensor in network_info['net'].items()}
+    tensors['scores'] = np.asarray(scores, dtype=np.float32)
+    write_checkpoint(ckpt_file, tensors, network=network_name(network_info['net']), config=network_info['config'],
+        episode=episode, mean_score=float(mean_score), num_episodes=len(scores),
+        final_mean_score=float(means[-1]) if len(means) else None, source=os.path.basename(pth_file), **meta)
+    return ckpt_file
+
+
+def refresh_index(directory, pattern, index_file, describe, version):
+    '''
+        Refresh a json index of the files of a directory, calling describe only for the files that are new
+        or changed (by modification time and size) since it was written.
+    Params
+    ======
+        directory (str): directory of the indexed files
+        pattern (str): glob pattern of the indexed files, like "*.ckpt"
+        index_file (str): name of the index in directory
+        describe (function): called with the path of a file, returns its json description
+        version (str): version of the descriptions, the whole index is rebuilt when it changes
+    return the index, file name -> description
+    '''
+    index_file = os.path.join(directory, index_file)
+    entries = {}
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+        if index.get('version') == version:
+            entries = index['files']
+
+    files = {}
+    changed = False
+    for path in sorted(glob.glob(os.path.join(directory, pattern))):
+        name = os.path.basename(path)
+        stat = os.stat(path)
+        entry = entries.get(name)
+        if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+            entry = {'mtime': stat.st_mtime, 'size': stat.st_size, 'description': describe(path)}
+            changed = True
+        files[name] = entry
+    if changed or len(files) != len(entries):
+        # written like the checkpoints, so concurrent writers at worst redo each other's work
+        temporary = '{}.{}.tmp'.format(index_file, os.getpid())
+        with open(temporary, 'w') as f:
+            json.dump({'version': version, 'updated': time.time(), 'files': files}, f)
+        os.replace(temporary, index_file)
+    return {name: entry['description'] for name, entry in files.items()}
+
+
+def update_index(directory):
+    '''
+        Refresh the index of the .ckpt files of a directory, reading only the headers of the
+        files that are new or changed since it was written.
+        return the index, file name -> header without its tensors
+    '''
+    def describe(path):
+        return {k: v for k, v in read_header(path).items() if k not in ('tensors', 'data_start')}
+    return refresh_index(directory, '*.ckpt', INDEX_FILE, describe, 'ckpt-{}'.format(FORMAT_VERSION))
+
+
+def matches_where(header, where):
+    '''
+        Whether a header passes a filter, either a function called with the header or
+        a dict of config key -> required value.
+    '''
+    if callable(where):
+        return where(header)
+    config = header['config'] if header.get('config') else {}
+    return not where or all(key in config and config[key] == value for key, value in where.items())
+
+
+def query(directory, where=None, sort_by='mean_score', top=None):
+    '''
+        Checkpoints of a directory whose configuration matches where, best first.
+    Params
+    ======
+        directory (str): directory of the .ckpt files
+        where (dict): config key -> required value, or a function called with the header
+        sort_by (str): header key to sort by, in decreasing order
+        top (int): number of checkpoints returned, all of them when None
+    return a list of (file name, header)
+    '''
+    matches = []
+    for name, header in update_index(directory).items():
+        if matches_where(header, where):
+            matches.append((name, header))
+    matches.sort(key=lambda match: match[1][sort_by] if match[1].get(sort_by) is not None else -np.inf, reverse=True)
+    return matches[:top] if top is not None else matches
+
+
+def parse_where(conditions):
+    where = {}
+    for condition in conditions or []:
+        key, value = condition.split('=', 1)
+        try:
+            where[key] = json.loads(value)
+        except ValueError:
+            where[key] = value
+    return where
+
+
+parser = argparse.ArgumentParser(description="Convert checkpoints to the .ckpt format and query them")
+subparsers = parser.add_subparsers(dest='command')
+convert_parser = subparsers.add_parser('convert', help="Convert .pth checkpoints to .ckpt files next to them.")
+convert_parser.add_argument('checkpoints', nargs='+', help="Saved network .pth files.")
+query_parser = subparsers.add_parser('query', help="List the .ckpt checkpoints of a directory, best first.")
+query_parser.add_argument('directory', nargs='?', default='.', help="Directory of the .ckpt files.")
+query_parser.add_argument('--where', nargs='*', help="Configuration values to match, as key=value.")
+query_parser.add_argument('--sort-by', default='mean_score', help="Header value to sort by.")
+query_parser.add_argument('--top', type=int, help="Number of checkpoints listed.")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.command == 'convert':
+        for pth_file in args.checkpoints:
+            print('Converted {} to {}'.format(pth_file, convert(pth_file)))
+        for directory in sorted(set(os.path.dirname(os.path.abspath(f)) for f in args.checkpoints)):
+            update_index(directory)
+    elif args.command == 'query':
+        start = time.perf_counter()
+        matches = query(args.directory, parse_where(args.where), sort_by=args.sort_by, top=args.top)
+        elapsed = time.perf_counter() - start
+        print('{:<45} {:>16} {:>8} {:>8}'.format('checkpoint', 'network', 'episode', args.sort_by))
+        for name, header in matches:
+            print('{:<45} {:>16} {:>8} {:>8}'.format(name, header['network'], header['episode'],
+                '{:.2f}'.format(header[args.sort_by]) if isinstance(header.get(args.sort_by), float) else str(header.get(args.sort_by))))
+        print('{} checkpoint(s) in {:.1f} ms'.format(len(matches), elapsed * 1000))
+    else:
+        parser.print_help()
@@ -0,0 +1,129 @@
+import math
+import os
+import torch
+
+'''
+    Settings for training on cpu-only machines, from optional config keys.
+
+    Threads, applied once per process by configure_cpu :
+        cpu_threads (int): threads of each operation (intra-op), by default the torch default for a single
+            process, and the cores divided between the workers when several share the machine
+        cpu_interop_threads (int): threads running independent operations (inter-op)
+        cpu_pin (bool): pin each worker process to its own slice of the cores, on Linux, so that
+            concurrent trainings do not migrate between cores or share them
+    The small networks of this project gain little from many threads, several trainings with one
+    or two threads each use a node better than one training with all of them.
+
+    Learning, applied per run :
+        bf16_autocast (bool): run the forward and backward passes of Agent.learn in bfloat16,
+            the weights, the optimizer and the loss stay float32 (needs torch 1.10 or later, and only pays
+            off on cores with native bfloat16 instructions, AVX512-BF16 or AMX, elsewhere it is emulated)
+        batch_scale (int): learn from batches batch_scale times larger, batch_scale times less often,
+            so the same number of transitions is replayed in fewer, larger matrix products
+        lr_scaling (str): how the learning rate follows batch_scale, "linear" (default), "sqrt" or "none"
+'''
+CPU_KEYS = ('cpu_threads', 'cpu_interop_threads', 'cpu_pin')
+
+def available_cores():
+    '''
+        Cores this process may run on.
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def cpu_settings(config):
+    '''
+        The keys of CPU_KEYS set in a configuration.  They apply to a whole process, so unlike the
+        other keys they cannot be lists of values to sweep over.
+    '''
+    settings = {k: config[k] for k in CPU_KEYS if k in config}
+    for key, value in settings.items():
+        if isinstance(value, list):
+            raise Exception('{} applies to every run of a process and cannot be swept, got {}'.format(key, value))
+    return settings
+
+
+def configure_cpu(config, worker_id=0, num_workers=1):
+    '''
+        Set the threads of this process, and its cores with cpu_pin.
+    Params
+    ======
+        config (dict): configuration holding the optional keys of CPU_KEYS
+        worker_id (int): index of this process among the ones sharing the machine
+        num_workers (int): number of processes sharing the machine
+    return the settings in effect
+    '''
+    config = cpu_settings(config)
+    cores = available_cores()
+    share = max(1, len(cores) // num_workers)
+    pinned = 'cpu_pin' in config and config['cpu_pin']
+    if pinned:
+        if not hasattr(os, 'sched_setaffinity'):
+            raise Exception('cpu_pin needs os.sched_setaffinity, which this platform does not have')
+        # workers beyond the number of slices wrap around, sharing a slice rather than every core
+        first = worker_id % (len(cores) // share) * share
+        cores = cores[first:first + share]
+        os.sched_setaffinity(0, cores)
+    if 'cpu_threads' in config:
+        torch.set_num_threads(config['cpu_threads'])
+    elif num_workers > 1 or pinned:
+        torch.set_num_threads(share)
+    if 'cpu_interop_threads' in config and config['cpu_interop_threads'] != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(config['cpu_interop_threads'])
+        except RuntimeError:
+            # torch only accepts it before its first parallel operation
+            print('The inter-op threads of this process are already set to {}, cpu_interop_threads is ignored'.format(
+                torch.get_num_interop_threads()))
+    return {'cores': cores, 'threads': torch.get_num_threads(), 'interop_threads': torch.get_num_interop_threads()}
+
+
+def scale_batch(config):
+    '''
+        Configuration with batch_size, learning_rate and learn_every (or replay_ratio) scaled by batch_scale.
+        The unscaled values are kept as base_batch_size, base_learning_rate and base_learn_every (or
+        base_replay_ratio), so that scaling a configuration again does not compound.
+    '''
+    scale = config['batch_scale'] if 'batch_scale' in config else 1
+    if scale == 1 or 'base_batch_size' in config:
+        return config
+    lr_scaling = config['lr_scaling'] if 'lr_scaling' in config else 'linear'
+    if lr_scaling == 'linear':
+        lr_factor = scale
+    elif lr_scaling == 'sqrt':
+        lr_factor = math.sqrt(scale)
+    elif lr_scaling == 'none':
+        lr_factor = 1.
+    else:
+        raise Exception('Unknown lr_scaling {}, expected "linear", "sqrt" or "none"'.format(lr_scaling))
+    scaled = dict(config, base_batch_size=config['batch_size'], base_learning_rate=config['learning_rate'],
+        batch_size=int(config['batch_size'] * scale), learning_rate=config['learning_rate'] * lr_factor)
+    if 'replay_ratio' in config:
+        scaled.update(base_replay_ratio=config['replay_ratio'], replay_ratio=config['replay_ratio'] / scale)
+    else:
+        scaled.update(base_learn_every=config['learn_every'], learn_every=int(config['learn_every'] * scale))
+    return scaled
+
+
+class _NoAutocast:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def learn_autocast(config, device):
+    '''
+        Context manager factory wrapped around the forward pass of Agent.learn, bfloat16 autocast
+        with bf16_autocast, and nothing otherwise.
+    '''
+    if 'bf16_autocast' not in config or not config['bf16_autocast']:
+        return _NoAutocast
+    if device.type != 'cpu':
+        raise Exception('bf16_autocast is a cpu mode, the agent runs on {}'.format(device))
+    if not hasattr(torch, 'autocast'):
+        raise Exception('bf16_autocast needs torch 1.10 or later, torch {} is installed'.format(torch.__version__))
+    return lambda: torch.autocast('cpu', dtype=torch.bfloat16)
@@ -1,7 +1,13 @@
+import json
+import os
 import numpy as np
 import random
-from collections import namedtuple, deque
-from model import QNetwork, DuelingQNetwork
+import threading
+from model import QNetwork, DuelingQNetwork, flatten_parameters
+from instrumentation import NULL_TELEMETRY
+from cpu_mode import learn_autocast
+from prefetch import PrefetchSampler
+from segment_tree import SumSegmentTree, MinSegmentTree
 import torch
 import torch.nn.functional as F
 import torch.optim as optim
@@ -31,65 +37,197 @@ class Agent():
         # Q-Network
         self.qnetwork_local = network_class(state_size, action_size).to(device)
         self.qnetwork_target = network_class(state_size, action_size).to(device)
-        self.little_bit = torch.tensor(1e-10).to(device)
-        self.weight_normalizer = torch.tensor(1./config['replay_buffer_size']).to(device)
+        # contiguous views of the weights, so the target update is one in-place operation
+        self.local_flat = flatten_parameters(self.qnetwork_local)
+        self.target_flat = flatten_parameters(self.qnetwork_target)
+        # number of learning steps, used to copy the weights every target_update_every steps
+        self.learn_steps = 0
         self.optimizer = optim.Adam(self.qnetwork_local.parameters(), lr=config['learning_rate'])
+        # bfloat16 forward and backward passes with bf16_autocast, see cpu_mode.py
+        self.autocast = learn_autocast(config, device)
 
-        # Replay memory
-        self.memory = ReplayBuffer(action_size, config['replay_buffer_size'], config['batch_size'], seed)
+        # Replay memory, kept in memory mapped files when replay_dir is set,
+        # and storing each observation once with replay_compact
+        storage = {
+            'storage_dir': config['replay_dir'] if 'replay_dir' in config else None,
+            'compact': config['replay_compact'] if 'replay_compact' in config else False,
+            'obs_dtype': config['replay_obs_dtype'] if 'replay_obs_dtype' in config else 'float32',
+            'obs_range': config['replay_obs_range'] if 'replay_obs_range' in config else None,
+        }
+        if config['prioritized_replay']:
+            self.memory = PrioritizedReplayBuffer(action_size, config['replay_buffer_size'], config['batch_size'], seed,
+                config['alpha'], state_size=state_size, **storage)
+        else:
+            self.memory = ReplayBuffer(action_size, config['replay_buffer_size'], config['batch_size'], seed,
+                state_size=state_size, **storage)
+        # start from the experience of a previous run
+        if 'replay_warm_start' in config and config['replay_warm_start']:
+            self.memory.warm_start(config['replay_warm_start'])
         # Initialize time step (for updating every learn_every steps)
         self.t_step = 0
+        # fractional updates owed, when a replay_ratio (updates per env step) replaces learn_every
+        self.update_credit = 0.
+
+        # guards the replay memory against the prefetching thread
+        self.memory_lock = threading.Lock()
+        num_prefetch = config['prefetch'] if 'prefetch' in config else 0
+        self.sampler = PrefetchSampler(self.sample_memory, self.memory_lock, num_prefetch) if num_prefetch > 0 else None
+        # phase timings, replaced by an instrumentation.Telemetry to record them
+        self.telemetry = NULL_TELEMETRY
+        # trajectories.TrajectoryRecorder keeping the experiences of step and step_batch, see train.start_recorder
+        self.recorder = None
+        # losses of the updates since the last pop_loss, kept on the device to avoid a sync per update
+        self.loss_sum = 0.
+        self.loss_updates = 0
     
     def step(self, state, action, reward, next_state, done):
         # Save experience in replay memory
-        self.memory.add(state, action, reward, next_state, done)
-        
-        # Learn every learn_every time steps.
-        self.t_step = (self.t_step + 1) % self.config['learn_every']
-        if self.t_step == 0:
+        with self.telemetry.timer('replay_add'), self.memory_lock:
+            self.memory.add(state, action, reward, next_state, done)
+        if self.recorder is not None:
+            self.recorder.add(state, action, reward, next_state, done)
+        self.learn_after_steps(1)
+
+    def step_batch(self, states, actions, rewards, next_states, dones):
+        """Save a batch of experiences, one per environment copy, and learn as many times as
+        the learn_every gate would have for the same number of single steps."""
+        with self.telemetry.timer('replay_add'), self.memory_lock:
+            self.memory.add_batch(states, actions, rewards, next_states, dones)
+        if self.recorder is not None:
+            self.recorder.add_batch(states, actions, rewards, next_states, dones)
+        self.learn_after_steps(len(states))
+
+    def learn_after_steps(self, num_steps):
+        """Run the learning updates owed after num_steps environment steps, either one
+        every learn_every steps, or replay_ratio per step when it is configured."""
+        if 'replay_ratio' in self.config:
+            self.update_credit += num_steps * self.config['replay_ratio']
+            num_updates = int(self.update_credit)
+            self.update_credit -= num_updates
+        else:
+            # Learn every learn_every time steps.
+            num_updates, self.t_step = divmod(self.t_step + num_steps, self.config['learn_every'])
+        for _ in range(num_updates):
             # If enough samples are available in memory, get random subset and learn
             if len(self.memory) > self.config['batch_size']:
-                experiences, random_indices = self.memory.sample()
-                self.learn(experiences, random_indices, self.config['gamma'])
+                self.learn_from_memory()
+
+    def sample_memory(self):
+        """Sample a batch from the replay memory, with importance-sampling weights for prioritized replay."""
+        if self.config['prioritized_replay']:
+            return self.memory.sample(self.config['beta'])
+        experiences, random_indices = self.memory.sample()
+        return experiences, random_indices, None
+
+    def learn_from_memory(self):
+        """Learn from the next prefetched batch, or from a batch sampled now when prefetching is off."""
+        with self.telemetry.timer('replay_sample'):
+            if self.sampler is not None:
+                experiences, random_indices, weights = self.sampler.get()
+            else:
+                experiences, random_indices, weights = self.sample_memory()
+        self.learn(experiences, random_indices, self.config['gamma'], weights)
+
+    def close(self):
+        """Stop the prefetching thread, if any, and write the header of a disk-backed replay memory."""
+        if self.sampler is not None:
+            self.sampler.close()
+        if self.memory.storage_dir is not None:
+            self.memory.snapshot()
 
     def act(self, state, eps=0.):
         """Returns actions for given state as per current policy.
         
         Params
         ======
-            state (array_like): current state
+            state (array_like): current state, or a num_envs x state_size batch of states
             eps (float): epsilon, for epsilon-greedy action selection
         """
-        state = torch.from_numpy(state).float().unsqueeze(0).to(device)
+        batched = np.ndim(state) == 2
+        state = torch.from_numpy(np.asarray(state)).float()
+        if not batched:
+            state = state.unsqueeze(0)
+        state = state.to(device)
         self.qnetwork_local.eval()
         with torch.no_grad():
             action_values = self.qnetwork_local(state)
         self.qnetwork_local.train()
 
+        if batched:
+            # one forward pass for all the states, then epsilon-greedy on each row
+            actions = action_values.argmax(1).cpu().numpy()
+            explore = np.random.random_sample(len(actions)) < eps
+            actions[explore] = np.random.randint(self.action_size, size=int(explore.sum()))
+            return actions
+
         # Epsilon-greedy action selection
         if random.random() > eps:
             return int(np.argmax(action_values.cpu().data.numpy()))
         else:
             return random.choice(np.arange(self.action_size))
 
-    def learn(self, experiences, random_indices, gamma):
+    def pop_loss(self):
+        '''
+            Mean loss of the updates since the last call, nan without updates, and the number of updates.
+        '''
+        loss_sum, updates = self.loss_sum, self.loss_updates
+        self.loss_sum = 0.
+        self.loss_updates = 0
+        return (float(loss_sum) / updates if updates > 0 else float('nan')), updates
+
+    def learn(self, experiences, random_indices, gamma, weights=None):
         """Update value parameters using given batch of experience tuples.
 
         Params
         ======
             experiences (Tuple[torch.Tensor]): tuple of (s, a, r, s', done) tuples 
+            random_indices (array_like): buffer slots of the experiences, used to update their priorities,
+                None for experiences that do not come from the replay memory
             gamma (float): discount factor
+            weights (torch.Tensor): importance-sampling weights for prioritized replay, batch_size x 1
         """
+        with self.telemetry.timer('forward'), self.autocast():
+            loss = self.compute_loss(experiences, random_indices, gamma, weights)
+        self.loss_sum = self.loss_sum + loss.detach()
+        self.loss_updates += 1
+
+        # Minimize the loss
+        with self.telemetry.timer('backward'):
+            self.optimizer.zero_grad()
+            loss.backward()
+        with self.telemetry.timer('optimizer'):
+            self.optimizer.step()
+
+        # ------------------- update target network ------------------- #
+        with self.telemetry.timer('target_update'):
+            self.learn_steps += 1
+            if 'target_update_every' in self.config:
+                # hard update, copy the weights every target_update_every learning steps
+                if self.learn_steps % self.config['target_update_every'] == 0:
+                    self.hard_update(self.qnetwork_local, self.qnetwork_target)
+            else:
+                self.soft_update(self.qnetwork_local, self.qnetwork_target, self.config['tau'])
+
+    def compute_loss(self, experiences, random_indices, gamma, weights=None):
+        """Loss of a batch of experience tuples, updating their priorities for prioritized replay.
+        The parameters are the same as learn."""
         states, actions, rewards, next_states, dones = experiences
 
         if self.config['double_dqn']:
             # https://arxiv.org/pdf/1509.06461.pdf Deep Reinforcement Learning with Double Q-learning
             # "For each update, one set of weights is used to determine the greedy policy and the other to determine its value."
-            # the next line evaluates the q for the next states and gets the indices of the best actions with the max(1)[1] call.
+            # the local network is evaluated once on the states and the next states stacked together,
+            # the first half gives the expected Q values and the second half the greedy next actions
+            batch_size = states.shape[0]
+            local_values = self.qnetwork_local(torch.cat([states, next_states]))
+            # Get expected Q values from local model
+            Q_expected = local_values[:batch_size].gather(1, actions)
+            # get the indices of the best next actions with the max(1)[1] call.
             # unsqueeze makes them a batch_size x 1 tensor to be used with gather
-            local_net_actions = self.qnetwork_local(next_states).detach().max(1)[1].unsqueeze(1)
+            local_net_actions = local_values[batch_size:].detach().max(1)[1].unsqueeze(1)
             # determine the value of these actions
-            Q_targets_next = self.qnetwork_target(next_states).gather(1, local_net_actions)
+            with torch.no_grad():
+                Q_targets_next = self.qnetwork_target(next_states).gather(1, local_net_actions)
         else:
             # use the standard dqn algorithm, where the same network is used to determine the greedy policy AND determine its value
             # Get max predicted Q values (for next states) from target model
@@ -97,49 +235,31 @@ class Agent():
             # maximum value along the column dimension, returning the BATCH_SIZE maximum values and
             # their indices.  The [0] takes the maximum values (and not their indices), and unsqueeze 
             # makes that vector into a tensor of BATCH_SIZE x 1
-            Q_targets_next = self.qnetwork_target(next_states).detach().max(1)[0].unsqueeze(1)
+            with torch.no_grad():
+                Q_targets_next = self.qnetwork_target(next_states).max(1)[0].unsqueeze(1)
+            # Get expected Q values from local model
+            Q_expected = self.qnetwork_local(states).gather(1, actions)
 
+        # under bf16_autocast the networks output bfloat16, the targets and the loss are computed in float32
+        Q_expected = Q_expected.float()
         # Compute Q targets for current states 
-        Q_targets = rewards + (gamma * Q_targets_next * (1 - dones))
-
-        # Get expected Q values from local model
-        Q_expected = self.qnetwork_local(states).gather(1, actions)
+        Q_targets = rewards + (gamma * Q_targets_next.float() * (1 - dones))
 
-        if self.config['prioritized_replay']:
+        if self.config['prioritized_replay'] and random_indices is not None:
             # the first step in the loss is the difference
             diffs = Q_expected - Q_targets
+            # scale each squared error by its importance-sampling weight, to correct
+            # for the bias introduced by the non-uniform sampling
+            loss = torch.mean(weights * torch.square(diffs))
 
-            # use the abs difference plus a little bit
-            # compute sampling priority (|di|+e)**alpha
-            priority = torch.pow(torch.add(self.little_bit, 
-                    torch.abs(diffs.clone().detach())), 
-                    self.config['alpha'])
-
-            # the new sampling probability for each of the sampled experiences
-            probs = priority / torch.sum(priority)
-
-            # finish computing the loss.  first compute the weights
-            weights = torch.pow((self.weight_normalizer * 1./probs), self.config['beta'])
-            max_weight = torch.max(weights)
-            # normalize to the maximum for stability
-            weights /= max_weight
-            # finish the loss
-            loss = torch.mean(torch.square(weights * diffs))
-
-            # update the sampling weights with these probabilities
-            for index, prob in zip(random_indices, probs):
-                self.memory.sampling_weights[index] = prob
+            # the new priority of each sampled experience is its absolute td error
+            td_errors = diffs.detach().cpu().numpy()
+            with self.memory_lock:
+                self.memory.update_priorities(random_indices, td_errors)
         else:
             # Compute regular loss
             loss = F.mse_loss(Q_expected, Q_targets)
-
-        # Minimize the loss
-        self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
-
-        # ------------------- update target network ------------------- #
-        self.soft_update(self.qnetwork_local, self.qnetwork_target, self.config['tau'])                     
+        return loss
 
     def soft_update(self, local_model, target_model, tau):
         """Soft update model parameters.
@@ -151,14 +271,73 @@ class Agent():
             target_model (PyTorch model): weights will be copied to
             tau (float): interpolation parameter 
         """
-        for target_param, local_param in zip(target_model.parameters(), local_model.parameters()):
-            target_param.data.copy_(tau*local_param.data + (1.0-tau)*target_param.data)
+        with torch.no_grad():
+            if local_model is self.qnetwork_local and target_model is self.qnetwork_target:
+                # one in-place kernel over the flattened weights, θ_target += τ*(θ_local - θ_target)
+                self.target_flat.lerp_(self.local_flat, tau)
+            else:
+                for target_param, local_param in zip(target_model.parameters(), local_model.parameters()):
+                    target_param.lerp_(local_param, tau)
+
+    def hard_update(self, local_model, target_model):
+        """Copy the local model parameters into the target model."""
+        with torch.no_grad():
+            if local_model is self.qnetwork_local and target_model is self.qnetwork_target:
+                self.target_flat.copy_(self.local_flat)
+            else:
+                for target_param, local_param in zip(target_model.parameters(), local_model.parameters()):
+                    target_param.copy_(local_param)
+
+
+# files of a disk-backed replay buffer, the version of its replay.json header,
+# and the number of transitions copied at a time
+REPLAY_FIELDS = ('states', 'actions', 'rewards', 'next_states', 'dones')
+COMPACT_REPLAY_FIELDS = ('observations', 'state_ptrs', 'next_ptrs', 'actions', 'rewards', 'dones')
+REPLAY_FORMAT_VERSION = 1
+REPLAY_CHUNK = 65536
+
+def remove_replay(directory):
+    """Delete the disk-backed replay buffer in directory, its header first so that it is never seen half removed."""
+    names = ['replay.json'] + ['{}.npy'.format(name) for name in REPLAY_FIELDS + COMPACT_REPLAY_FIELDS + ('sum_tree', 'min_tree')]
+    for name in names:
+        file_name = os.path.join(directory, name)
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+
+def read_replay_header(directory):
+    """The header of the disk-backed replay buffer in directory, None if there is none."""
+    file_name = os.path.join(directory, 'replay.json')
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name) as f:
+        header = json.load(f)
+    if header['format_version'] != REPLAY_FORMAT_VERSION:
+        raise Exception('Unsupported replay buffer format version {} in {}'.format(header['format_version'], directory))
+    return header
 
 
 class ReplayBuffer:
-    """Fixed-size buffer to store experience tuples."""
+    """Fixed-size ring buffer to store experience tuples.
 
-    def __init__(self, action_size, buffer_size, batch_size, seed):
+    Transitions are written into preallocated, contiguous numpy arrays (one per field)
+    at a cursor that wraps around once the buffer is full, so adding is O(1) and a
+    batch is assembled with a single fancy-indexed gather per field.
+
+    With a storage_dir the arrays are .npy files mapped into memory, so the buffer can be
+    larger than the available RAM, and replay.json records its cursor and size.  Opening a
+    storage_dir that already holds a buffer continues it, without reading it into memory.
+
+    A compact buffer stores every observation once : the observations go to their own ring
+    and each transition points to its state and next state there, so the next state of a
+    transition is shared with the state of the one that follows it in its trajectory.
+    Actions, rewards and dones are packed into uint8, float16 and bool.  The observations
+    can also be stored as float16, or quantized to uint8 over a fixed range, in either mode.
+    The batches are decoded back to the usual dtypes, so Agent.learn sees no difference.
+    """
+
+    def __init__(self, action_size, buffer_size, batch_size, seed, state_size=None, pin_memory=None, storage_dir=None,
+            compact=False, obs_dtype='float32', obs_range=None, obs_capacity=None):
         """Initialize a ReplayBuffer object.
 
         Params
@@ -167,46 +346,522 @@ class ReplayBuffer:
             buffer_size (int): maximum size of buffer
             batch_size (int): size of each training batch
             seed (int): random seed
+            state_size (int): dimension of each state, if None the storage is allocated on the first add
+            pin_memory (bool): gather batches into reusable pinned tensors, defaults to True on cuda
+            storage_dir (str): directory of the memory mapped files, None to keep the buffer in RAM
+            compact (bool): store every observation once, and pack the other fields into small dtypes
+            obs_dtype (str): storage of the observations, "float32", "float16" or "uint8"
+            obs_range (tuple): (low, high) range of the observations quantized to uint8, outside values are clipped
+            obs_capacity (int): size of the observation ring of a compact buffer, defaults to 1.25 * buffer_size
         """
         buffer_size = int(buffer_size)
         self.action_size = action_size
-        self.memory = deque(maxlen=buffer_size)
+        self.buffer_size = buffer_size
         self.batch_size = batch_size
-        self.experience = namedtuple("Experience", field_names=["state", "action", "reward", "next_state", "done"])
         self.seed = random.seed(seed)
-        self.sampling_weights = np.ones(buffer_size) / float(buffer_size)
-        # set of indices representing each value in the buffer
-        self.indices = np.arange(buffer_size)
-        
+        self.rng = np.random.RandomState(seed)
+        self.pin_memory = device.type == 'cuda' if pin_memory is None else pin_memory
+        self.compact = compact
+        self.obs_dtype = np.dtype(obs_dtype)
+        if self.obs_dtype not in (np.float32, np.float16, np.uint8):
+            raise Exception('Unsupported observation dtype {}'.format(obs_dtype))
+        if self.obs_dtype == np.uint8 and obs_range is None:
+            raise Exception('Quantizing the observations to uint8 needs their (low, high) range')
+        self.obs_range = tuple(obs_range) if obs_range is not None else None
+        # every transition needs one new observation, plus one at the start of each trajectory
+        self.obs_capacity = int(obs_capacity) if obs_capacity is not None else buffer_size + buffer_size // 4
+        # position of the next write and number of valid transitions
+        self.cursor = 0
+        self.size = 0
+        # number of observations ever written to the ring of a compact buffer
+        self.obs_count = 0
+        self.state_size = None
+        self.states = None
+        self.storage_dir = storage_dir
+        # header of the buffer found in storage_dir, if any
+        self.header = None
+        if storage_dir is not None:
+            os.makedirs(storage_dir, exist_ok=True)
+            self.header = read_replay_header(storage_dir)
+        if self.header is not None:
+            self._check_header(self.header, storage_dir, state_size)
+            self.cursor = self.header['cursor']
+            self.size = self.header['size']
+            self.obs_count = self.header['obs_count'] if 'obs_count' in self.header else 0
+            self._allocate(self.header['state_size'])
+        elif state_size is not None:
+            self._allocate(state_size)
+
+    def _check_header(self, header, storage_dir, state_size):
+        """Make sure the buffer found in storage_dir is the one that was asked for."""
+        expected = {
+            'buffer_size': self.buffer_size,
+            'compact': self.compact,
+            'obs_dtype': self.obs_dtype.name,
+            'obs_capacity': self.obs_capacity if self.compact else None,
+        }
+        if state_size is not None:
+            expected['state_size'] = state_size
+        for key, value in expected.items():
+            # the keys missing from older headers have their default value
+            found = header[key] if key in header else {'compact': False, 'obs_dtype': 'float32', 'obs_capacity': None}[key]
+            if found != value:
+                raise Exception('The replay buffer in {} has {} {}, not {}'.format(storage_dir, key, found, value))
+
+    def _allocate(self, state_size):
+        """Preallocate the storage arrays, and the pinned staging tensors if requested."""
+        self.state_size = state_size
+        if self.compact:
+            self.observations = self._new_field('observations', (self.obs_capacity, state_size), self.obs_dtype)
+            # write counts of the observations, so that a pointer to an overwritten observation can be detected
+            self.state_ptrs = self._new_field('state_ptrs', (self.buffer_size,), np.int64)
+            self.next_ptrs = self._new_field('next_ptrs', (self.buffer_size,), np.int64)
+            self.actions = self._new_field('actions', (self.buffer_size, 1), np.uint8 if self.action_size <= 256 else np.int32)
+            self.rewards = self._new_field('rewards', (self.buffer_size, 1), np.float16)
+            self.dones = self._new_field('dones', (self.buffer_size, 1), np.bool_)
+            # write count of the last next state added by each row of add_batch, -1 at the end of a trajectory
+            self.stream_ptrs = np.full(0, -1, dtype=np.int64)
+        else:
+            self.states = self._new_field('states', (self.buffer_size, state_size), self.obs_dtype)
+            self.next_states = self._new_field('next_states', (self.buffer_size, state_size), self.obs_dtype)
+            # keep the trailing dimension so that the gathered batches are already batch_size x 1
+            self.actions = self._new_field('actions', (self.buffer_size, 1), np.int64)
+            self.rewards = self._new_field('rewards', (self.buffer_size, 1), np.float32)
+            self.dones = self._new_field('dones', (self.buffer_size, 1), np.float32)
+        # the fields can be gathered as they are stored
+        self._decoded = not self.compact and self.obs_dtype == np.float32
+
+        self._staging = None
+        self._copy_event = None
+        if self.pin_memory:
+            self._staging = tuple(torch.empty((self.batch_size,) + shape, dtype=dtype).pin_memory()
+                for shape, dtype in (((state_size,), torch.float32), ((1,), torch.int64), ((1,), torch.float32),
+                    ((state_size,), torch.float32), ((1,), torch.float32)))
+
+    def _new_field(self, name, shape, dtype, fill=0):
+        """A zeroed array (or filled with fill), memory mapped from storage_dir/name.npy for a disk-backed buffer."""
+        if self.storage_dir is None:
+            return np.full(shape, fill, dtype=dtype)
+        file_name = os.path.join(self.storage_dir, name + '.npy')
+        if self.header is not None:
+            field = np.load(file_name, mmap_mode='r+')
+            if field.shape != shape or field.dtype != dtype:
+                raise Exception('{} holds a {} {} array, expected {} {}'.format(file_name, field.shape, field.dtype, shape, np.dtype(dtype)))
+            return field
+        # the new file is sparse, so only the pages that are written take up disk space
+        field = np.lib.format.open_memmap(file_name, mode='w+', dtype=dtype, shape=shape)
+        if fill != 0:
+            field[:] = fill
+        return field
+
+    def _fields(self):
+        if self.compact:
+            return (self.observations, self.state_ptrs, self.next_ptrs, self.actions, self.rewards, self.dones)
+        return (self.states, self.actions, self.rewards, self.next_states, self.dones)
+
+    def _header(self):
+        header = {
+            'format_version': REPLAY_FORMAT_VERSION,
+            'buffer_size': self.buffer_size,
+            'state_size': self.state_size,
+            'cursor': self.cursor,
+            'size': self.size,
+            'compact': self.compact,
+            'obs_dtype': self.obs_dtype.name,
+            'obs_range': self.obs_range,
+        }
+        if self.compact:
+            header.update(obs_capacity=self.obs_capacity, obs_count=self.obs_count)
+        return header
+
+    def _arrays(self):
+        """Every array written by snapshot, by file name, with the length of its part in use."""
+        if self.compact:
+            used = [min(self.obs_count, self.obs_capacity)] + [self.size] * 5
+            return {name: (field, n) for name, field, n in zip(COMPACT_REPLAY_FIELDS, self._fields(), used)}
+        return {name: (field, self.size) for name, field in zip(REPLAY_FIELDS, self._fields())}
+
+    def nbytes(self):
+        """Bytes taken by the stored transitions."""
+        return sum(array.nbytes for array, _ in self._arrays().values()) if self.state_size is not None else 0
+
+    def _encode(self, observations):
+        """Observations in their storage dtype."""
+        if self.obs_dtype == np.uint8:
+            low, high = self.obs_range
+            scaled = (np.clip(observations, low, high) - low) * (255. / (high - low))
+            return np.rint(scaled).astype(np.uint8)
+        return np.asarray(observations, dtype=self.obs_dtype)
+
+    def _decode(self, observations):
+        """Stored observations back to float32."""
+        if self.obs_dtype == np.uint8:
+            low, high = self.obs_range
+            return observations.astype(np.float32) * np.float32((high - low) / 255.) + np.float32(low)
+        return observations.astype(np.float32)
+
+    def snapshot(self, directory=None):
+        """
+            Write the buffer to disk, in the format of a storage_dir.
+            A disk-backed buffer is flushed in place when directory is None, otherwise the
+            arrays are copied to directory, which can then be reopened as a storage_dir or
+            passed to warm_start.
+        """
+        if self.state_size is None:
+            raise Exception('Cannot snapshot a ReplayBuffer before its first transition')
+        directory = self.storage_dir if directory is None else directory
+        if directory is None:
+            raise Exception('A ReplayBuffer kept in RAM needs a directory to snapshot to')
+        os.makedirs(directory, exist_ok=True)
+        in_place = self.storage_dir is not None and os.path.abspath(directory) == os.path.abspath(self.storage_dir)
+        for name, (array, used) in self._arrays().items():
+            if in_place:
+                array.flush()
+                continue
+            copy = np.lib.format.open_memmap(os.path.join(directory, name + '.npy'), mode='w+', dtype=array.dtype, shape=array.shape)
+            # the rest of the file stays sparse
+            for start in range(0, used, REPLAY_CHUNK):
+                copy[start:start + REPLAY_CHUNK] = array[start:min(start + REPLAY_CHUNK, used)]
+            copy.flush()
+            del copy
+        # the header is replaced last, so it never describes arrays that are not written yet
+        temporary = os.path.join(directory, 'replay.json.tmp')
+        with open(temporary, 'w') as f:
+            json.dump(self._header(), f)
+        os.replace(temporary, os.path.join(directory, 'replay.json'))
+
+    def warm_start(self, directory):
+        """
+            Add the transitions of a buffer snapshot, oldest first, so that the most recent ones are
+            kept when this buffer is smaller.  They are read a chunk at a time from the memory mapped
+            files, and added like new transitions.
+        """
+        header = read_replay_header(directory)
+        if header is None:
+            raise Exception('No replay buffer snapshot in {}'.format(directory))
+        # open the snapshot as a buffer of its own layout, only to read from it
+        source = ReplayBuffer(self.action_size, header['buffer_size'], 1, 0, pin_memory=False, storage_dir=directory,
+            compact=header['compact'] if 'compact' in header else False,
+            obs_dtype=header['obs_dtype'] if 'obs_dtype' in header else 'float32',
+            obs_range=header['obs_range'] if 'obs_range' in header else None,
+            obs_capacity=header['obs_capacity'] if 'obs_capacity' in header else None)
+        size = source.size
+        # a full snapshot wrapped around, so its oldest transition is at the cursor
+        oldest = source.cursor if size == source.buffer_size else 0
+        count = min(size, self.buffer_size)
+        added = 0
+        for start in range(size - count, size, REPLAY_CHUNK):
+            slots = (oldest + np.arange(start, min(start + REPLAY_CHUNK, size))) % size
+            slots = slots[source._valid(slots)]
+            if len(slots) > 0:
+                self.add_batch(*source._read(slots))
+                added += len(slots)
+        print('Warm started the replay buffer with {} transitions from {}'.format(added, directory))
+
     def add(self, state, action, reward, next_state, done):
         """Add a new experience to memory."""
-        e = self.experience(state, action, reward, next_state, done)
-        self.memory.append(e)
-    
+        if self.compact:
+            self._add_compact(np.reshape(state, (1, -1)), [action], [reward], np.reshape(next_state, (1, -1)), [done])
+            return
+        if self.state_size is None:
+            self._allocate(len(state))
+        i = self.cursor
+        self.states[i] = self._encode(state)
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.next_states[i] = self._encode(next_state)
+        self.dones[i] = done
+        self.cursor = (i + 1) % self.buffer_size
+        self.size = min(self.size + 1, self.buffer_size)
+
+    def add_batch(self, states, actions, rewards, next_states, dones):
+        """Add one experience per row of the arguments, wrapping around the end of the buffer."""
+        if self.compact:
+            return self._add_compact(states, actions, rewards, next_states, dones)
+        if self.state_size is None:
+            self._allocate(np.shape(states)[1])
+        n = len(states)
+        slots = (self.cursor + np.arange(n)) % self.buffer_size
+        self.states[slots] = self._encode(states)
+        self.actions[slots] = np.reshape(actions, (n, 1))
+        self.rewards[slots] = np.reshape(rewards, (n, 1))
+        self.next_states[slots] = self._encode(next_states)
+        self.dones[slots] = np.reshape(dones, (n, 1))
+        self.cursor = (self.cursor + n) % self.buffer_size
+        self.size = min(self.size + n, self.buffer_size)
+        return slots
+
+    def _add_compact(self, states, actions, rewards, next_states, dones):
+        """
+            Add transitions to a compact buffer.  Row i is expected to continue the trajectory of row i
+            of the previous call, as the environment copies do in train.dqn_vec, and its state then reuses
+            the stored next state of that row.  Whenever they differ the state is stored again, so a
+            mismatched row only costs space.
+        """
+        if self.state_size is None:
+            self._allocate(np.shape(states)[1])
+        n = len(states)
+        capacity = self.obs_capacity
+        encoded_states = self._encode(states)
+        encoded_next_states = self._encode(next_states)
+        dones = np.reshape(dones, n).astype(bool)
+
+        if len(self.stream_ptrs) < n:
+            self.stream_ptrs = np.concatenate([self.stream_ptrs, np.full(n - len(self.stream_ptrs), -1, dtype=np.int64)])
+        previous = self.stream_ptrs[:n]
+        # the previous next state must survive the 2n observations written below
+        reuse = previous >= max(0, self.obs_count + 2 * n - capacity)
+        reuse[reuse] = np.all(self.observations[previous[reuse] % capacity] == encoded_states[reuse], axis=1)
+        stored = np.flatnonzero(~reuse)
+
+        state_ptrs = previous.copy()
+        state_ptrs[stored] = self.obs_count + np.arange(len(stored))
+        next_ptrs = self.obs_count + len(stored) + np.arange(n)
+        self.observations[state_ptrs[stored] % capacity] = encoded_states[stored]
+        self.observations[next_ptrs % capacity] = encoded_next_states
+        self.obs_count += len(stored) + n
+        # a finished trajectory is not continued
+        self.stream_ptrs[:n] = np.where(dones, -1, next_ptrs)
+
+        slots = (self.cursor + np.arange(n)) % self.buffer_size
+        self.state_ptrs[slots] = state_ptrs
+        self.next_ptrs[slots] = next_ptrs
+        self.actions[slots] = np.reshape(actions, (n, 1))
+        self.rewards[slots] = np.reshape(rewards, (n, 1))
+        self.dones[slots] = np.reshape(dones, (n, 1))
+        self.cursor = (self.cursor + n) % self.buffer_size
+        self.size = min(self.size + n, self.buffer_size)
+        return slots
+
+    def _valid(self, indices):
+        """Whether the observations of the transitions at indices are still stored, always true unless compact."""
+        if not self.compact:
+            return np.ones(len(indices), dtype=bool)
+        # the state is never written after the next state
+        return self.state_ptrs[indices] >= self.obs_count - self.obs_capacity
+
+    def _read(self, indices):
+        """The transitions at indices as (s, a, r, s', done) arrays, in the dtypes Agent.learn expects."""
+        if self.compact:
+            return (self._decode(self.observations[self.state_ptrs[indices] % self.obs_capacity]),
+                self.actions[indices].astype(np.int64),
+                self.rewards[indices].astype(np.float32),
+                self._decode(self.observations[self.next_ptrs[indices] % self.obs_capacity]),
+                self.dones[indices].astype(np.float32))
+        if self._decoded:
+            return tuple(field[indices] for field in self._fields())
+        return (self._decode(self.states[indices]), self.actions[indices], self.rewards[indices],
+            self._decode(self.next_states[indices]), self.dones[indices])
+
+    def state_dict(self):
+        """Contents of the buffer, as views of the filled slots (which are always [0, size)).
+        A disk-backed buffer is flushed instead, and only referred to by its storage_dir."""
+        if self.storage_dir is not None:
+            self.snapshot()
+            return {'cursor': self.cursor, 'size': self.size, 'storage_dir': self.storage_dir}
+        if self.compact:
+            return {
+                'cursor': self.cursor,
+                'size': self.size,
+                'obs_count': self.obs_count,
+                'arrays': {name: field[:used] for name, (field, used) in self._arrays().items()},
+            }
+        return {
+            'cursor': self.cursor,
+            'size': self.size,
+            'fields': [field[:self.size] for field in self._fields()],
+        }
+
+    def load_state_dict(self, state):
+        """Restore the contents saved by state_dict, whose arrays can also be tensors, as in a checkpoint."""
+        if 'storage_dir' in state:
+            if self.storage_dir is None or os.path.abspath(state['storage_dir']) != os.path.abspath(self.storage_dir):
+                self.warm_start(state['storage_dir'])
+                return
+            # the transitions are already in the reopened files
+        elif 'arrays' in state:
+            if self.state_size is None:
+                self._allocate(state['arrays']['observations'].shape[1])
+            for name, (field, _) in self._arrays().items():
+                field[:len(state['arrays'][name])] = np.asarray(state['arrays'][name])
+            self.obs_count = state['obs_count']
+        else:
+            if self.state_size is None:
+                self._allocate(state['fields'][0].shape[1])
+            for field, saved in zip(self._fields(), state['fields']):
+                field[:state['size']] = np.asarray(saved)
+        self.cursor = state['cursor']
+        self.size = state['size']
+
+    def sample_indices(self):
+        """Choose batch_size slots uniformly from the filled part of the buffer."""
+        if self.size == 0:
+            raise ValueError('Cannot sample from an empty ReplayBuffer')
+        indices = self.rng.randint(0, self.size, size=self.batch_size)
+        if self.compact:
+            # draw again the transitions whose observations were overwritten
+            invalid = np.flatnonzero(~self._valid(indices))
+            while len(invalid) > 0:
+                indices[invalid] = self.rng.randint(0, self.size, size=len(invalid))
+                invalid = invalid[~self._valid(indices[invalid])]
+        if self.storage_dir is not None:
+            # gathering in file order touches the pages of the memory map sequentially
+            indices.sort()
+        return indices
+
+    def gather(self, indices):
+        """Gather the transitions stored at indices into a tuple of (s, a, r, s', done) tensors on the device."""
+        if self._staging is None:
+            return tuple(torch.from_numpy(field).to(device) for field in self._read(indices))
+
+        # the previous batch may still be copying out of the staging tensors
+        if self._copy_event is not None:
+            self._copy_event.synchronize()
+        batch = []
+        fields = self._fields() if self._decoded else self._read(indices)
+        for field, staging in zip(fields, self._staging):
+            if self._decoded:
+                np.take(field, indices, axis=0, out=staging.numpy())
+            else:
+                staging.numpy()[:] = field
+            batch.append(staging.to(device, non_blocking=True))
+        self._copy_event = torch.cuda.Event()
+        self._copy_event.record()
+        return tuple(batch)
+
     def sample(self):
         """
             Randomly sample a batch of experiences from memory.
-            return the batched experiences and the list of indices that were chosen,
-                in case we are using prioritized replay
-        """
-        # get a set of random indices, weighted by the sampling weights
-        current_size = len(self.memory)
-        random_indices = random.choices(self.indices[:current_size], weights=self.sampling_weights[:current_size], k=self.batch_size)
-        # get the experiences corresponding to these indices
-        experiences = []
-        for idx in random_indices:
-            experiences.append(self.memory[idx])
-
-        #experiences = random.sample(self.memory, k=self.batch_size)
-
-        states = torch.from_numpy(np.vstack([e.state for e in experiences if e is not None])).float().to(device)
-        actions = torch.from_numpy(np.vstack([e.action for e in experiences if e is not None])).long().to(device)
-        rewards = torch.from_numpy(np.vstack([e.reward for e in experiences if e is not None])).float().to(device)
-        next_states = torch.from_numpy(np.vstack([e.next_state for e in experiences if e is not None])).float().to(device)
-        dones = torch.from_numpy(np.vstack([e.done for e in experiences if e is not None]).astype(np.uint8)).float().to(device)
-  
-        return (states, actions, rewards, next_states, dones), random_indices
+            return the batched experiences and the list of indices that were chosen
+        """
+        random_indices = self.sample_indices()
+        return self.gather(random_indices), random_indices
 
     def __len__(self):
         """Return the current size of internal memory."""
-        return len(self.memory)
\ No newline at end of file
+        return self.size
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """Ring buffer that samples transitions proportionally to their priority.
+
+    Based on https://arxiv.org/pdf/1511.05952.pdf Prioritized Experience Replay.
+    Priorities live in a sum-tree (for O(log N) proportional sampling) and a min-tree
+    (for the largest importance-sampling weight), indexed by ring buffer slot, so a
+    priority always stays with its transition after the buffer wraps.
+    """
+
+    def __init__(self, action_size, buffer_size, batch_size, seed, alpha, state_size=None, pin_memory=None, eps=1e-6,
+            storage_dir=None, compact=False, obs_dtype='float32', obs_range=None, obs_capacity=None):
+        """Initialize a PrioritizedReplayBuffer object.
+
+        Params
+        ======
+            action_size (int): dimension of each action
+            buffer_size (int): maximum size of buffer
+            batch_size (int): size of each training batch
+            seed (int): random seed
+            alpha (float): how much prioritization is used, 0 is uniform sampling
+            state_size (int): dimension of each state, if None the storage is allocated on the first add
+            pin_memory (bool): gather batches into reusable pinned tensors, defaults to True on cuda
+            eps (float): added to the absolute td error so that no transition has zero priority
+            storage_dir (str): directory of the memory mapped files, including the priorities, None to keep the buffer in RAM
+            compact, obs_dtype, obs_range, obs_capacity: compact storage, see ReplayBuffer
+        """
+        super().__init__(action_size, buffer_size, batch_size, seed, state_size=state_size, pin_memory=pin_memory,
+            storage_dir=storage_dir, compact=compact, obs_dtype=obs_dtype, obs_range=obs_range, obs_capacity=obs_capacity)
+        self.alpha = alpha
+        self.eps = eps
+        self.sum_tree = SumSegmentTree(self.buffer_size)
+        self.min_tree = MinSegmentTree(self.buffer_size)
+        # new transitions get the largest priority seen so far, so they are replayed at least once
+        self.max_priority = 1.0
+        if storage_dir is not None:
+            self.sum_tree.tree = self._new_field('sum_tree', self.sum_tree.tree.shape, np.float64)
+            self.min_tree.tree = self._new_field('min_tree', self.min_tree.tree.shape, np.float64, fill=np.inf)
+        if self.header is not None:
+            self.max_priority = self.header['max_priority']
+
+    def add(self, state, action, reward, next_state, done):
+        """Add a new experience to memory, with the maximum priority."""
+        i = self.cursor
+        super().add(state, action, reward, next_state, done)
+        priority = self.max_priority ** self.alpha
+        self.sum_tree[i] = priority
+        self.min_tree[i] = priority
+
+    def add_batch(self, states, actions, rewards, next_states, dones):
+        """Add one experience per row of the arguments, each with the maximum priority."""
+        slots = super().add_batch(states, actions, rewards, next_states, dones)
+        priority = self.max_priority ** self.alpha
+        self.sum_tree[slots] = priority
+        self.min_tree[slots] = priority
+        return slots
+
+    def _header(self):
+        header = super()._header()
+        header.update(alpha=self.alpha, max_priority=self.max_priority)
+        return header
+
+    def _arrays(self):
+        arrays = super()._arrays()
+        arrays.update(sum_tree=(self.sum_tree.tree, len(self.sum_tree.tree)), min_tree=(self.min_tree.tree, len(self.min_tree.tree)))
+        return arrays
+
+    def state_dict(self):
+        state = super().state_dict()
+        # the compact and disk-backed states already hold the trees
+        if 'storage_dir' not in state and 'arrays' not in state:
+            state.update(sum_tree=self.sum_tree.tree, min_tree=self.min_tree.tree)
+        state['max_priority'] = float(self.max_priority)
+        return state
+
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        if 'sum_tree' in state:
+            self.sum_tree.tree[:] = np.asarray(state['sum_tree'])
+            self.min_tree.tree[:] = np.asarray(state['min_tree'])
+        self.max_priority = state['max_priority']
+
+    def sample_indices(self):
+        """Stratified sampling: draw one slot from each of batch_size equal segments of the total priority."""
+        if self.size == 0:
+            raise ValueError('Cannot sample from an empty ReplayBuffer')
+        while True:
+            segment = self.sum_tree.sum() / self.batch_size
+            prefixsums = (np.arange(self.batch_size) + self.rng.random_sample(self.batch_size)) * segment
+            indices = self.sum_tree.find_prefixsum_idx(prefixsums)
+            # guard against floating point round off walking into an empty slot
+            indices = np.minimum(indices, self.size - 1)
+            invalid = ~self._valid(indices)
+            if not invalid.any():
+                return indices
+            # transitions of a compact buffer whose observations were overwritten are never sampled again
+            self.sum_tree[indices[invalid]] = 0.
+            self.min_tree[indices[invalid]] = np.inf
+
+    def importance_weights(self, indices, beta):
+        """Importance-sampling weights (N * P(i))^-beta, normalized by the largest possible weight."""
+        total = self.sum_tree.sum()
+        probs = self.sum_tree[indices] / total
+        max_weight = (self.min_tree.min() / total * self.size) ** (-beta)
+        weights = (probs * self.size) ** (-beta) / max_weight
+        return weights.astype(np.float32).reshape(-1, 1)
+
+    def sample(self, beta):
+        """
+            Sample a batch of experiences proportionally to their priority.
+            return the batched experiences, the indices that were chosen (to update their priorities
+                after learning) and the importance-sampling weights as a batch_size x 1 tensor
+        """
+        indices = self.sample_indices()
+        weights = torch.from_numpy(self.importance_weights(indices, beta)).to(device)
+        return self.gather(indices), indices, weights
+
+    def update_priorities(self, indices, td_errors):
+        """Set the priorities of the sampled slots from their new td errors, for the whole batch at once."""
+        priorities = np.abs(np.asarray(td_errors, dtype=np.float64).reshape(-1)) + self.eps
+        self.max_priority = max(self.max_priority, priorities.max())
+        priorities = priorities ** self.alpha
+        self.sum_tree[indices] = priorities
+        self.min_tree[indices] = priorities
@@ -0,0 +1,246 @@
+import argparse
+import copy
+import json
+import math
+import time
+from collections import OrderedDict
+import numpy as np
+import torch
+from dqn_agent import device
+from export_policy import checkpoint_layers
+from vec_env import HeadlessBananaEnv, UnityVecEnv
+
+'''
+    Evaluate many checkpoints at once, for model selection.
+    Checkpoints with the same architecture are stacked, so that every layer of all of
+    them runs as a single batched matrix multiply, and each network plays its own slice
+    of one batched environment :
+        python evaluate.py model_*.pth baseline_hyperparams_*.pth --episodes 200
+    Each checkpoint gets the mean of its scores with a bootstrap confidence interval,
+    and a few percentiles of the score distribution.
+'''
+UNITY_FILE = "./Banana_Windows_x86_64/Banana.exe"
+# Unity copies running at once, each one is a separate process
+MAX_UNITY_ENVS = 8
+
+class StackedNetworks:
+    def __init__(self, network, layer_sets):
+        '''
+        Stack the weights of networks that share an architecture.
+        Params
+        ======
+            network (str): "QNetwork" or "DuelingQNetwork"
+            layer_sets (list): the layers of each network, as returned by export_policy.checkpoint_layers
+        '''
+        self.network = network
+        self.num_networks = len(layer_sets)
+        # stream name -> list of (num_networks x in x out weights, num_networks x 1 x out biases)
+        self.streams = {}
+        for name in layer_sets[0]:
+            self.streams[name] = [
+                (torch.from_numpy(np.stack([layers[name][i][0] for layers in layer_sets])).float().to(device),
+                    torch.from_numpy(np.stack([layers[name][i][1] for layers in layer_sets])).float().unsqueeze(1).to(device))
+                for i in range(len(layer_sets[0][name]))]
+
+    def _forward(self, name, x):
+        layers = self.streams[name]
+        for weight, bias in layers[:-1]:
+            x = torch.relu(torch.baddbmm(bias, x, weight))
+        weight, bias = layers[-1]
+        return torch.baddbmm(bias, x, weight)
+
+    def q_values(self, states):
+        '''
+            Action values of num_networks x batch x state_size states, the batch of states
+            in row i is evaluated by network i.
+        '''
+        if self.network == 'DuelingQNetwork':
+            value = self._forward('value', states)
+            advantage = self._forward('advantage', states)
+            return value + (advantage - advantage.mean(dim=2, keepdim=True))
+        return self._forward('q', states)
+
+    def select(self, indices):
+        '''
+            The stacked networks at indices, which can repeat.
+        '''
+        selected = copy.copy(self)
+        selected.num_networks = len(indices)
+        index = torch.as_tensor(indices, dtype=torch.int64, device=device)
+        selected.streams = {name: [(weight[index], bias[index]) for weight, bias in layers] for name, layers in self.streams.items()}
+        return selected
+
+    def act(self, states):
+        '''
+            Greedy actions, num_networks x batch, for num_networks x batch x state_size states.
+        '''
+        with torch.no_grad():
+            states = torch.from_numpy(np.asarray(states, dtype=np.float32)).to(device)
+            if self.network == 'DuelingQNetwork':
+                # as in policy.NumpyPolicy.act, the advantages alone pick the greedy action
+                scores = self._forward('advantage', states)
+            else:
+                scores = self._forward('q', states)
+            return scores.argmax(dim=2).cpu().numpy()
+
+
+def load_groups(checkpoint_files):
+    '''
+        Group the checkpoints by architecture.
+        return a list of (checkpoint files, StackedNetworks) pairs
+    '''
+    groups = OrderedDict()
+    for file_name in checkpoint_files:
+        network, layers, state_size, action_size, _ = checkpoint_layers(file_name)
+        key = (network,) + tuple((name, tuple(w.shape for w, _ in stream)) for name, stream in sorted(layers.items()))
+        groups.setdefault(key, ([], []))
+        groups[key][0].append(file_name)
+        groups[key][1].append(layers)
+    return [(files, StackedNetworks(key[0], layer_sets)) for key, (files, layer_sets) in groups.items()]
+
+
+def play(networks, vec_env, envs_per_network, num_episodes, eps=0., rng=None):
+    '''
+        Play num_episodes episodes with every stacked network, envs_per_network at a time.
+    Params
+    ======
+        networks (StackedNetworks): networks to evaluate
+        vec_env: batched environment with num_networks * envs_per_network copies,
+            the copies [i * envs_per_network, (i + 1) * envs_per_network) are played by network i
+        envs_per_network (int): environment copies played by each network
+        num_episodes (int): episodes played by each network
+        eps (float): probability of a random action
+        rng (np.random.RandomState): source of the random actions
+    return num_networks x num_episodes scores
+    '''
+    rng = rng if rng is not None else np.random.RandomState(0)
+    num_networks = networks.num_networks
+    num_envs = num_networks * envs_per_network
+    scores = []
+    for _ in range(int(math.ceil(num_episodes / envs_per_network))):
+        states = vec_env.reset(train_mode=True)
+        episode_scores = np.zeros(num_envs)
+        active = np.ones(num_envs, dtype=bool)
+        while active.any():
+            actions = networks.act(states.reshape(num_networks, envs_per_network, -1)).reshape(num_envs)
+            if eps > 0.:
+                explore = rng.random_sample(num_envs) < eps
+                actions = np.where(explore, rng.randint(vec_env.action_size, size=num_envs), actions)
+            states, rewards, dones = vec_env.step(actions)
+            episode_scores += rewards * active
+            active &= ~dones
+        scores.append(episode_scores.reshape(num_networks, envs_per_network))
+    return np.concatenate(scores, axis=1)[:, :num_episodes]
+
+
+def summarize(scores, confidence=0.95, percentiles=(5, 25, 50, 75, 95), num_bootstrap=10000, rng=None):
+    '''
+        Statistics of the scores of one checkpoint, with a percentile bootstrap
+        confidence interval of the mean.
+    '''
+    rng = rng if rng is not None else np.random.RandomState(0)
+    scores = np.asarray(scores, dtype=np.float64)
+    means = scores[rng.randint(len(scores), size=(num_bootstrap, len(scores)))].mean(axis=1)
+    tail = (1. - confidence) / 2 * 100
+    low, high = np.percentile(means, [tail, 100 - tail])
+    return {
+        'episodes': len(scores),
+        'mean': float(scores.mean()),
+        'std': float(scores.std(ddof=1)) if len(scores) > 1 else 0.,
+        'ci_low': float(low),
+        'ci_high': float(high),
+        'confidence': confidence,
+        'percentiles': {str(p): float(v) for p, v in zip(percentiles, np.percentile(scores, percentiles))},
+        'min': float(scores.min()),
+        'max': float(scores.max()),
+    }
+
+
+def evaluate(checkpoint_files, num_episodes=100, envs_per_network=25, env_type='unity', file_name=UNITY_FILE,
+        eps=0., seed=0, confidence=0.95, max_envs=None):
+    '''
+        Evaluate every checkpoint on num_episodes episodes.
+        max_envs caps the environment copies running at once (MAX_UNITY_ENVS by default for Unity),
+        the networks of a group are then played a slice at a time, with fewer copies each.
+        return an ordered dict of checkpoint file -> summary, best mean score first
+    '''
+    if env_type == 'headless':
+        print('Warning: the headless environment is a numpy stand-in for the Unity banana environment the '
+            'checkpoints were trained on, its scores do not measure how well they play it')
+    elif max_envs is None:
+        max_envs = MAX_UNITY_ENVS
+    rng = np.random.RandomState(seed)
+    groups = load_groups(checkpoint_files)
+    if max_envs is not None:
+        envs_per_network = min(envs_per_network, max_envs)
+    # the groups with the same number of copies follow each other and share an environment, a single
+    # one is open at a time, and each Unity launch takes worker ids (ports) none of the earlier ones used
+    sizes = []
+    for files, networks in groups:
+        per_slice = networks.num_networks if max_envs is None else max(1, min(max_envs // envs_per_network, networks.num_networks))
+        sizes.append((per_slice * envs_per_network, per_slice))
+    order = sorted(range(len(groups)), key=lambda i: sizes[i][0])
+    vec_env = None
+    next_worker_id = 0
+    results = {}
+    for i in order:
+        files, networks = groups[i]
+        num_envs, per_slice = sizes[i]
+        if vec_env is None or vec_env.num_envs != num_envs:
+            if vec_env is not None:
+                vec_env.close()
+            if env_type == 'headless':
+                vec_env = HeadlessBananaEnv(num_envs=num_envs, seed=seed)
+            else:
+                vec_env = UnityVecEnv(file_name, num_envs, base_worker_id=next_worker_id)
+                next_worker_id += num_envs
+        print('Evaluating {} {} on {} environments'.format(len(files), networks.network, num_envs))
+        start = time.time()
+        scores = []
+        for first in range(0, networks.num_networks, per_slice):
+            indices = list(range(first, min(first + per_slice, networks.num_networks)))
+            played = len(indices)
+            # the last slice repeats its last network to fill the copies, and drops its scores
+            indices += [indices[-1]] * (per_slice - played)
+            scores.append(play(networks.select(indices), vec_env, envs_per_network, num_episodes,
+                eps=eps, rng=rng)[:played])
+        scores = np.concatenate(scores)
+        print('{} episodes in {:.1f}s'.format(scores.size, time.time() - start))
+        for file_name_i, network_scores in zip(files, scores):
+            results[file_name_i] = summarize(network_scores, confidence=confidence, rng=rng)
+            results[file_name_i]['network'] = networks.network
+    if vec_env is not None:
+        vec_env.close()
+    return OrderedDict(sorted(results.items(), key=lambda item: item[1]['mean'], reverse=True))
+
+
+def print_table(results):
+    print('\n{:<45} {:>8} {:>17} {:>7} {:>7} {:>7} {:>7} {:>7}'.format(
+        'checkpoint', 'mean', 'ci', 'p5', 'p25', 'p50', 'p75', 'p95'))
+    for file_name, summary in results.items():
+        p = summary['percentiles']
+        print('{:<45} {:>8.2f} {:>17} {:>7.1f} {:>7.1f} {:>7.1f} {:>7.1f} {:>7.1f}'.format(
+            file_name, summary['mean'], '[{:.2f}, {:.2f}]'.format(summary['ci_low'], summary['ci_high']),
+            p['5'], p['25'], p['50'], p['75'], p['95']))
+
+
+parser = argparse.ArgumentParser(description="Evaluate many saved networks with confidence intervals")
+parser.add_argument('checkpoints', nargs='+', help="Saved network .pth or .ckpt files.")
+parser.add_argument('--episodes', type=int, default=100, help="Evaluation episodes for each checkpoint.")
+parser.add_argument('--envs-per-network', type=int, default=25, help="Environment copies played at once by each checkpoint.")
+parser.add_argument('--env', default='unity', choices=['unity', 'headless'], help="Environment to evaluate on, headless is only a stand-in for the Unity one.")
+parser.add_argument('--max-envs', type=int, help="Environment copies running at once, {} by default for Unity.".format(MAX_UNITY_ENVS))
+parser.add_argument('--eps', type=float, default=0., help="Probability of a random action.")
+parser.add_argument('--seed', type=int, default=0, help="Random seed of the environments and of the bootstrap.")
+parser.add_argument('--confidence', type=float, default=0.95, help="Confidence level of the interval of the mean.")
+parser.add_argument('--output', help="Json file the results are written to.")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    results = evaluate(args.checkpoints, num_episodes=args.episodes, envs_per_network=args.envs_per_network,
+        env_type=args.env, eps=args.eps, seed=args.seed, confidence=args.confidence, max_envs=args.max_envs)
+    print_table(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+        print('Results written to {}'.format(args.output))
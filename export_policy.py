@@ -0,0 +1,58 @@
+import argparse
+import os
+import torch
+from policy import save_policy
+import checkpoint_format
+
+'''
+    Convert a .pth (or .ckpt) checkpoint written by train.dqn into a .npz file for policy.NumpyPolicy.
+'''
+def checkpoint_layers(checkpoint_file):
+    '''
+        Read the weights of a .pth checkpoint as numpy arrays.
+        return the network name, the layers in the format of policy.save_policy,
+            the state size, the action size and the training configuration
+    '''
+    if checkpoint_file.endswith('.ckpt'):
+        network_info = checkpoint_format.load_network(checkpoint_file)
+    else:
+        network_info = torch.load(checkpoint_file, map_location='cpu')
+    config = network_info['config']
+    state_dict = network_info['net']
+    # older checkpoints predate the is_dueling key, so look at the weights themselves
+    if 'value_net.fc1.weight' in state_dict:
+        network = 'DuelingQNetwork'
+        streams = {'value': 'value_net.', 'advantage': 'advantage_net.'}
+    else:
+        network = 'QNetwork'
+        # some early checkpoints nest the layers in a submodule, e.g. model.fc1.weight
+        prefixes = [k[:-len('fc1.weight')] for k in state_dict if k.endswith('fc1.weight')]
+        if len(prefixes) != 1:
+            raise Exception('Cannot find the layers of the network in {}'.format(checkpoint_file))
+        streams = {'q': prefixes[0]}
+
+    layers = {}
+    for name, prefix in streams.items():
+        layers[name] = [(state_dict['{}fc{}.weight'.format(prefix, i)].numpy().T,
+                state_dict['{}fc{}.bias'.format(prefix, i)].numpy())
+            for i in (1, 2, 3)]
+    last_stream = layers['advantage' if network == 'DuelingQNetwork' else 'q']
+    state_size = last_stream[0][0].shape[0]
+    action_size = last_stream[-1][1].shape[0]
+    return network, layers, state_size, action_size, config
+
+
+def export(checkpoint_file, policy_file):
+    network, layers, state_size, action_size, config = checkpoint_layers(checkpoint_file)
+    save_policy(policy_file, network, layers, state_size, action_size, config=config)
+    return policy_file
+
+
+parser = argparse.ArgumentParser(description="Export a trained network to a torch-free policy file")
+parser.add_argument('checkpoint', help="Path to a saved network .pth or .ckpt file.")
+parser.add_argument('output', nargs='?', help="Path of the .npz policy file, defaults to the checkpoint name with a .npz extension.")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    output = args.output if args.output else os.path.splitext(args.checkpoint)[0] + '.npz'
+    print('Exported {} to {}'.format(args.checkpoint, export(args.checkpoint, output)))
@@ -0,0 +1,288 @@
+import argparse
+import json
+import os
+import warnings
+import numpy as np
+from checkpoint_format import rolling_means, matches_where, parse_where, refresh_index
+
+'''
+    Per-episode history of training runs, in an append-only columnar file per run.
+
+    A .hist file is made of
+        8 bytes      MAGIC
+        8 bytes      length of the header, little endian
+        header       json : format version, config of the run and the dtype of every column
+        chunks       each a 4 byte row count followed by the rows of every column, one after the other
+    so a column is read by hopping over the chunks without touching the other columns, and a run
+    that stops half way through a chunk only loses that chunk.  A resumed run appends to its file,
+    and the rows written last win for the episodes that were played again.
+
+    Every directory holding .hist files can have an index, history_index.json, with the config and
+    a summary of each run, refreshed only for the files that changed :
+        python history.py . --where gamma=0.99 --threshold 13
+'''
+MAGIC = b'NAVHIST\x00'
+FORMAT_VERSION = 1
+INDEX_FILE = 'history_index.json'
+# the lab instructions state that an average score of 13 over 100 episodes counts as solving the environment
+SOLVED_SCORE = 13.
+WINDOW = 100
+
+COLUMNS = [
+    ('episode', np.int32),
+    ('score', np.float32),
+    # rolling mean of the last WINDOW scores
+    ('mean_score', np.float32),
+    # epsilon used during the episode
+    ('eps', np.float32),
+    ('steps', np.int32),
+    # learning updates during the episode, and their mean loss (nan without updates), so that the column
+    # sums to the updates of the run : the episodes played in lockstep by train.dqn_vec share their updates,
+    # which are all counted on the row of the last of them, the others have 0 updates
+    ('updates', np.int32),
+    ('loss', np.float32),
+    # seconds since the run started, at the end of the episode
+    ('wall_time', np.float64),
+]
+
+def _read_header(f, file_name):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise Exception('{} is not a .hist run history'.format(file_name))
+    length = int.from_bytes(f.read(8), 'little')
+    header = json.loads(f.read(length).decode('utf-8'))
+    if header['format_version'] != FORMAT_VERSION:
+        raise Exception('Unsupported history format version {} in {}'.format(header['format_version'], file_name))
+    return header
+
+
+def read_header(file_name):
+    with open(file_name, 'rb') as f:
+        return _read_header(f, file_name)
+
+
+class HistoryWriter:
+    def __init__(self, file_name, config, resume_episode=None, flush_every=25):
+        '''
+        Params
+        ======
+            file_name (str): .hist file of the run
+            config (dict): training configuration, stored in the header
+            resume_episode (int): episode a resumed run continues from, the file is started over when None
+            flush_every (int): episodes buffered in memory before they are appended as a chunk
+        '''
+        self.file_name = file_name
+        self.flush_every = flush_every
+        self.columns = [(name, np.dtype(dtype)) for name, dtype in COLUMNS]
+        self.rows = []
+        # wall time already spent by the run being resumed
+        self.wall_offset = 0.
+        if resume_episode is not None and os.path.exists(file_name):
+            history = read_history(file_name, ['wall_time'])
+            played = history['episode'] <= resume_episode
+            if played.any():
+                self.wall_offset = float(history['wall_time'][played][-1])
+            return
+        header = {
+            'format_version': FORMAT_VERSION,
+            'config': config,
+            'columns': [[name, dtype.str] for name, dtype in self.columns],
+        }
+        encoded = json.dumps(header).encode('utf-8')
+        with open(file_name, 'wb') as f:
+            f.write(MAGIC)
+            f.write(len(encoded).to_bytes(8, 'little'))
+            f.write(encoded)
+
+    def append(self, **record):
+        '''
+            Add the record of an episode, with a value for every column.
+        '''
+        record['wall_time'] += self.wall_offset
+        self.rows.append(tuple(record[name] for name, _ in self.columns))
+        if len(self.rows) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        columns = list(zip(*self.rows))
+        with open(self.file_name, 'ab') as f:
+            f.write(len(self.rows).to_bytes(4, 'little'))
+            for (_, dtype), values in zip(self.columns, columns):
+                f.write(np.asarray(values, dtype=dtype).tobytes())
+        self.rows = []
+
+    def close(self):
+        self.flush()
+
+
+def read_history(file_name, columns=None):
+    '''
+        Columns of a run history, one row per episode in episode order.
+    Params
+    ======
+        file_name (str): .hist file
+        columns (list): names of the columns to read, all of them when None, the episode column is always read
+    return a dict of column name -> numpy array
+    '''
+    with open(file_name, 'rb') as f:
+        header = _read_header(f, file_name)
+        layout = [(name, np.dtype(dtype)) for name, dtype in header['columns']]
+        names = [name for name, _ in layout]
+        wanted = set(names if columns is None else list(columns) + ['episode'])
+        missing = wanted - set(names)
+        if missing:
+            raise Exception('{} has no column {}'.format(file_name, ', '.join(sorted(missing))))
+        row_size = sum(dtype.itemsize for _, dtype in layout)
+        size = os.fstat(f.fileno()).st_size
+        parts = {name: [] for name in wanted}
+        position = f.tell()
+        while position + 4 <= size:
+            f.seek(position)
+            rows = int.from_bytes(f.read(4), 'little')
+            end = position + 4 + rows * row_size
+            if end > size:
+                # the chunk of a run that stopped while writing it
+                break
+            offset = position + 4
+            for name, dtype in layout:
+                if name in wanted:
+                    f.seek(offset)
+                    parts[name].append(np.frombuffer(f.read(rows * dtype.itemsize), dtype=dtype))
+                offset += rows * dtype.itemsize
+            position = end
+    history = {name: np.concatenate(parts[name]) if parts[name] else np.zeros(0, dtype=dict(layout)[name])
+        for name in wanted}
+    # keep the last row written for each episode, episodes played again after a resume replace the first ones
+    reversed_episodes = history['episode'][::-1]
+    _, last = np.unique(reversed_episodes, return_index=True)
+    rows = len(reversed_episodes) - 1 - last
+    return {name: values[rows] for name, values in history.items()}
+
+
+def windowed_mean(values, window=WINDOW):
+    '''
+        Mean of the last window values after each episode.
+    '''
+    return rolling_means(values, window)
+
+
+def time_to_threshold(scores, threshold=SOLVED_SCORE, window=WINDOW):
+    '''
+        First episode whose mean over the last window scores reaches threshold, None if none does.
+    '''
+    reached = np.flatnonzero(windowed_mean(scores, window) >= threshold)
+    return int(reached[0]) + 1 if len(reached) else None
+
+
+def load_column(file_names, column='score'):
+    '''
+        One column of several runs, as a number of episodes x number of runs array,
+        padded with nan after the end of the shorter runs.
+    '''
+    runs = [read_history(file_name, [column]) for file_name in file_names]
+    length = max([int(run['episode'].max()) if len(run['episode']) else 0 for run in runs] + [0])
+    values = np.full((length, len(runs)), np.nan)
+    for i, run in enumerate(runs):
+        values[run['episode'] - 1, i] = run[column]
+    return values
+
+
+def aggregate(file_names, column='score', window=WINDOW):
+    '''
+        Statistics across runs of the windowed mean of a column, for every episode.
+        return a dict of arrays, each with one value per episode : the mean, std, min and max
+            across the runs, and the number of runs that reached that episode
+    '''
+    values = load_column(file_names, column)
+    means = np.full(values.shape, np.nan)
+    for i in range(values.shape[1]):
+        played = ~np.isnan(values[:, i])
+        means[played, i] = windowed_mean(values[played, i], window)
+    counts = np.sum(~np.isnan(means), axis=1)
+    with warnings.catch_warnings():
+        # episodes that no run reached are nan
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return {
+            'episode': np.arange(1, len(values) + 1),
+            'mean': np.nanmean(means, axis=1),
+            'std': np.nanstd(means, axis=1),
+            'min': np.nanmin(means, axis=1),
+            'max': np.nanmax(means, axis=1),
+            'runs': counts,
+        }
+
+
+def summarize(file_name, threshold=SOLVED_SCORE, window=WINDOW):
+    '''
+        Summary of a run, as stored in the index.
+    '''
+    history = read_history(file_name, ['score', 'wall_time'])
+    means = windowed_mean(history['score'], window)
+    solved = time_to_threshold(history['score'], threshold, window)
+    return {
+        'config': read_header(file_name)['config'],
+        'episodes': len(history['episode']),
+        'best_mean_score': float(means.max()) if len(means) else None,
+        'best_episode': int(np.argmax(means)) + 1 if len(means) else None,
+        'final_mean_score': float(means[-1]) if len(means) else None,
+        'threshold': threshold,
+        'solved_episode': solved,
+        'wall_time': float(history['wall_time'][-1]) if len(means) else None,
+    }
+
+
+def update_index(directory, threshold=SOLVED_SCORE):
+    '''
+        Refresh the index of the run histories of a directory, summarizing only the files that
+        are new or changed since it was written, or all of them for another threshold.
+        return the index, file name -> summary
+    '''
+    return refresh_index(directory, '*.hist', INDEX_FILE, lambda path: summarize(path, threshold),
+        'hist-{}-threshold-{}'.format(FORMAT_VERSION, threshold))
+
+
+def find_runs(directory, where=None, threshold=SOLVED_SCORE):
+    '''
+        Run histories of a directory whose configuration matches where (a dict of config
+        key -> value, or a function called with the summary), fastest to solve first.
+        return a list of (file name, summary)
+    '''
+    runs = [(name, summary) for name, summary in update_index(directory, threshold).items() if matches_where(summary, where)]
+    runs.sort(key=lambda run: (run[1]['solved_episode'] is None, run[1]['solved_episode'] or 0, -(run[1]['best_mean_score'] or 0.)))
+    return runs
+
+
+def import_scores(pth_file, hist_file=None):
+    '''
+        Write the scores stored in an older .pth checkpoint as a run history, with only
+        its episode, score and mean_score columns filled in.
+    '''
+    import torch
+    hist_file = hist_file if hist_file is not None else os.path.splitext(pth_file)[0] + '.hist'
+    network_info = torch.load(pth_file, map_location='cpu')
+    scores = network_info['scores']
+    means = windowed_mean(scores)
+    writer = HistoryWriter(hist_file, network_info['config'], flush_every=len(scores) + 1)
+    for i, (score, mean_score) in enumerate(zip(scores, means)):
+        writer.append(episode=i + 1, score=score, mean_score=mean_score, eps=np.nan, steps=0, updates=0,
+            loss=np.nan, wall_time=np.nan)
+    writer.close()
+    return hist_file
+
+
+parser = argparse.ArgumentParser(description="Summarize the run histories of a directory")
+parser.add_argument('directory', nargs='?', default='.', help="Directory of the .hist files.")
+parser.add_argument('--where', nargs='*', help="Configuration values to match, as key=value.")
+parser.add_argument('--threshold', type=float, default=SOLVED_SCORE, help="Mean score over 100 episodes that solves the environment.")
+parser.add_argument('--import-pth', nargs='*', help="Write run histories from the scores of these .pth checkpoints first.")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    for pth_file in args.import_pth or []:
+        print('Imported the scores of {} to {}'.format(pth_file, import_scores(pth_file)))
+    runs = find_runs(args.directory, parse_where(args.where), args.threshold)
+    print('{:<45} {:>9} {:>10} {:>10} {:>10}'.format('run', 'episodes', 'best mean', 'final mean', 'solved at'))
+    for name, summary in runs:
+        print('{:<45} {:>9} {:>10.2f} {:>10.2f} {:>10}'.format(name, summary['episodes'], summary['best_mean_score'] or 0.,
+            summary['final_mean_score'] or 0., summary['solved_episode'] if summary['solved_episode'] is not None else '-'))
@@ -0,0 +1,178 @@
+import json
+import os
+import time
+from collections import defaultdict
+
+'''
+    Low overhead timing of the training hot path.
+    Phases are timed with `with telemetry.timer('act'):` blocks and events are counted with
+    telemetry.count('steps'), and at the end of each episode the totals are turned into one
+    record, passed to the registered hooks and appended as a line of json to a file.
+    When telemetry is off, NULL_TELEMETRY stands in with methods that do nothing, so the
+    instrumented code does not need to test whether it is enabled.
+
+    Phases timed by the agent and the training loops :
+        env_step, act, replay_add, replay_sample, forward, backward, optimizer, target_update, checkpoint
+    Note that on a gpu the forward and backward timings only cover launching the kernels.
+'''
+class _Timer:
+    __slots__ = ('totals', 'counts', 'name', 'start')
+
+    def __init__(self, totals, counts, name):
+        self.totals = totals
+        self.counts = counts
+        self.name = name
+        self.start = 0.
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.totals[self.name] += time.perf_counter() - self.start
+        self.counts[self.name] += 1
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def rss_megabytes():
+    '''
+        Resident memory of this process, from /proc on linux, otherwise the peak reported by getrusage.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        # kilobytes on linux, bytes on mac
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if os.uname().sysname == 'Darwin' else peak / 2**10
+    except (ImportError, AttributeError):
+        return None
+
+
+def replay_stats(memory):
+    '''
+        Occupancy of a replay buffer, and the spread of its priorities for prioritized replay.
+    '''
+    stats = {'buffer_size': len(memory), 'buffer_occupancy': len(memory) / memory.buffer_size,
+        'buffer_megabytes': memory.nbytes() / 2**20}
+    if hasattr(memory, 'sum_tree') and len(memory) > 0:
+        total = float(memory.sum_tree.sum())
+        stats.update(
+            priority_sum=total,
+            priority_mean=total / len(memory),
+            priority_min=float(memory.min_tree.min()),
+            priority_max=float(memory.max_priority ** memory.alpha),
+        )
+    return stats
+
+
+class Telemetry:
+    def __init__(self, file_name=None, hooks=None, append=False):
+        '''
+        Params
+        ======
+            file_name (str): jsonl file the episode records are written to, None to only call the hooks
+            hooks (list): functions called with each episode record (a dict)
+            append (bool): add to the records already in file_name, as a resumed run does, instead of starting it over
+        '''
+        self.enabled = True
+        self.file_name = file_name
+        self.hooks = list(hooks or [])
+        self.file = open(file_name, 'a' if append else 'w') if file_name else None
+        self._reset()
+
+    def _reset(self):
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.timers = {}
+        self.episode_start = time.perf_counter()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def timer(self, name):
+        '''
+            Context manager adding the time spent in its block to the phase called name.
+        '''
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = _Timer(self.totals, self.counts, name)
+        return timer
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def end_episode(self, i_episode, agent=None, **fields):
+        '''
+            Build the record of the episode that just ended, pass it to the hooks, write it,
+            and start counting the next episode from zero.
+        Params
+        ======
+            i_episode (int): episode number
+            agent (Agent): agent whose replay memory is described in the record
+            fields: other values to record, like the score or epsilon
+        '''
+        wall = time.perf_counter() - self.episode_start
+        record = {'episode': i_episode, 'wall_seconds': wall}
+        record.update(fields)
+        record['phase_seconds'] = dict(self.totals)
+        record['phase_calls'] = dict(self.counts)
+        record.update(self.counters)
+        record['steps_per_second'] = self.counters['steps'] / wall if wall > 0 else None
+        record['updates_per_second'] = self.counts['forward'] / wall if wall > 0 else None
+        if agent is not None:
+            record.update(replay_stats(agent.memory))
+        record['rss_mb'] = rss_megabytes()
+
+        for hook in self.hooks:
+            hook(record)
+        if self.file is not None:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+        self._reset()
+        return record
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class NullTelemetry:
+    '''
+        Telemetry that records nothing.
+    '''
+    enabled = False
+    _timer = _NullTimer()
+
+    def add_hook(self, hook):
+        raise Exception('Telemetry is disabled, create a Telemetry object to register hooks')
+
+    def timer(self, name):
+        return self._timer
+
+    def count(self, name, n=1):
+        pass
+
+    def end_episode(self, i_episode, agent=None, **fields):
+        return None
+
+    def close(self):
+        pass
+
+
+NULL_TELEMETRY = NullTelemetry()
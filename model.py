@@ -7,6 +7,22 @@ from collections import OrderedDict
     Starting with the model.py from the 
     Udacity\deep-reinforcement-learning\dqn\solution
 '''
+def flatten_parameters(module):
+    '''
+        Move all the parameters of a module into one contiguous tensor, and make each
+        parameter a view into it, so that an update of every weight is a single operation
+        on the returned tensor.  Call it after the module has been moved to its device,
+        since .to() would allocate new, separate tensors again.
+    '''
+    params = list(module.parameters())
+    flat = torch.cat([p.detach().reshape(-1) for p in params])
+    offset = 0
+    for p in params:
+        n = p.numel()
+        p.data = flat[offset:offset + n].view_as(p)
+        offset += n
+    return flat
+
 class QNetwork(nn.Module):
     def __init__(self, state_size, action_size, fc1_units=64, fc2_units=64):
         """Initialize parameters and build model.
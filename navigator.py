@@ -1,19 +1,23 @@
 import argparse
 import os
 import json
-import itertools
-from unityagents import UnityEnvironment
 from dqn_agent import Agent
+from vec_env import make_env
+from sweep import expand_configs, run_sweep
+from async_train import run_async
 import train
 import torch
+import checkpoint_format
+from cpu_mode import configure_cpu, scale_batch
 
-ALGORITHMS = {
-    "double_dqn", 
-    "prioritized_replay"
-}
+UNITY_FILE = "./Banana_Windows_x86_64/Banana.exe"
 
 parser = argparse.ArgumentParser(description="Train an agent to solve the banana environment")
 parser.add_argument('file', metavar='f', help="Path to a json configuration file or a saved network file.")
+parser.add_argument('--workers', type=int, default=1, help="Number of processes that train the hyper-parameter combinations in parallel, with early stopping.")
+parser.add_argument('--actors', type=int, default=0, help="Train asynchronously, with this many actor processes feeding a single learner.")
+parser.add_argument('--min-episodes', type=int, default=train.SCORE_WINDOW, help="Episodes before a parallel trial can be stopped early.")
+parser.add_argument('--eta', type=int, default=3, help="Only the top 1/eta of the parallel trials keep training at each stopping point.")
 
 if __name__ == '__main__':
     args = parser.parse_args()
@@ -21,47 +25,65 @@ if __name__ == '__main__':
     if not os.path.exists(args.file):
         raise Exception('Argument {} does not exist'.format(args.file))
 
-    env = UnityEnvironment(file_name="./Banana_Windows_x86_64/Banana.exe")
-    # get the default brain
-    brain_name = env.brain_names[0]
-    brain = env.brains[brain_name]
-
     _,ext = os.path.splitext(args.file)
-    if ext == ".pth":
+    if ext in (".pth", ".ckpt"):
+        from unityagents import UnityEnvironment
+        env = UnityEnvironment(file_name=UNITY_FILE)
+        # get the default brain
+        brain_name = env.brain_names[0]
+        brain = env.brains[brain_name]
         print("Running Agent from {}".format(args.file))
         env_info = env.reset(train_mode=False)[brain_name]
-        network_info = torch.load(args.file)
-        agent = Agent(state_size=len(env_info.vector_observations[0]), action_size=brain.vector_action_space_size, seed=0, config=network_info['config'])
+        network_info = torch.load(args.file) if ext == ".pth" else checkpoint_format.load_network(args.file)
+        # the agent only acts, so it does not open or warm start the replay buffer of the training run
+        config = dict(network_info['config'], replay_dir=None, replay_warm_start=None)
+        agent = Agent(state_size=len(env_info.vector_observations[0]), action_size=brain.vector_action_space_size, seed=0, config=config)
         agent.qnetwork_local.load_state_dict(network_info['net'])
         train.run(env, agent, brain_name)
     else:
         # train a new network
         with open(args.file) as f:
             info = json.load(f)
-            
-            # make each of the items into a list if it isn't already, so that we can 
-            # tune hyper parameters
-            hyper_config = {}
-            for k,v in info.items():
-                # create list if it isn't a list.  all other args should be scalars
-                hyper_config[k] = v if type(v) == list else [v]        
 
-            for i,values in enumerate(itertools.product(*hyper_config.values())):
-                config = dict(zip(hyper_config.keys(), values))
-                # for each of the algorithms, create a key with the boolean flag if it's on
-                for algo in ALGORITHMS:
-                    config[algo] = False
-                
-                for algo in config['algorithms']:
-                    config[algo] = True
+            if args.workers > 1:
+                run_sweep(info, args.workers, UNITY_FILE, min_episodes=args.min_episodes, eta=args.eta)
+                raise SystemExit
+
+            # threads (and cores with cpu_pin) of this process, the sweep workers above set their own
+            configure_cpu(info)
+
+            if args.actors > 0:
+                for i,config in enumerate(expand_configs(info)):
+                    # batch_scale applies as in serial training, the replay_dir and record_dir of run_config are not supported
+                    config = scale_batch(config)
+                    print('\n{} Training asynchronously with {}'.format(i+1, config))
+                    run_async(config, args.actors, '{}_{}.pth'.format(config['base_name'], i), file_name=UNITY_FILE)
+                raise SystemExit
 
+            # "env" selects the unity binary (default) or the numpy stand-in ("headless"),
+            # "num_envs" > 1 steps that many copies in lockstep
+            env, brain_name = make_env(info['env'] if 'env' in info else 'unity',
+                info['num_envs'] if 'num_envs' in info else 1, UNITY_FILE)
+
+            for i,config in enumerate(expand_configs(info)):
                 print('\n{} Training with {}'.format(i+1, config))
 
+                save_name = '{}_{}.pth'.format(config['base_name'], i)
+                config = train.run_config(config, save_name)
+                if brain_name is None:
+                    states = env.reset(train_mode=True)
+                    agent = Agent(state_size=states.shape[1], action_size=env.action_size, seed=0, config=config)
+                    train.dqn_vec(config, env, agent, save_name)
+                    agent.close()
+                    continue
+
                 # reset the environment to get its parameters
                 env_info = env.reset(train_mode=True)[brain_name]
+                brain = env.brains[brain_name]
                 # initialize an agent
                 agent = Agent(state_size=len(env_info.vector_observations[0]), action_size=brain.vector_action_space_size, seed=0, config=config)
 
                 # train the agent
-                train.dqn(config, env, agent, brain_name, '{}_{}.pth'.format(config['base_name'], i))
+                train.dqn(config, env, agent, brain_name, save_name)
+                agent.close()
     env.close()
\ No newline at end of file
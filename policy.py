@@ -0,0 +1,95 @@
+import json
+import numpy as np
+
+'''
+    Greedy policy runtime for trained networks, with numpy as its only dependency.
+    The weights come from export_policy.py, which converts a .pth checkpoint of a
+    QNetwork or a DuelingQNetwork into a .npz file, so that serving a trained agent
+    does not need torch, unityagents or a replay buffer.
+'''
+FORMAT_VERSION = 1
+
+def save_policy(file_name, network, layers, state_size, action_size, config=None):
+    '''
+        Write the weights of a network to a .npz policy file.
+    Params
+    ======
+        file_name (str): output file
+        network (str): "QNetwork" or "DuelingQNetwork"
+        layers (dict): stream name -> list of (weight, bias) numpy arrays, with the
+            weights stored as in_features x out_features so that a layer is x @ W + b
+        state_size (int): dimension of each state
+        action_size (int): dimension of each action
+        config (dict): training configuration, kept for reference
+    '''
+    meta = {
+        'format_version': FORMAT_VERSION,
+        'network': network,
+        'state_size': state_size,
+        'action_size': action_size,
+        'streams': {name: len(stream) for name, stream in layers.items()},
+        'config': config,
+    }
+    arrays = {'meta': np.frombuffer(json.dumps(meta).encode('utf-8'), dtype=np.uint8)}
+    for name, stream in layers.items():
+        for i, (weight, bias) in enumerate(stream):
+            arrays['{}.{}.weight'.format(name, i)] = np.ascontiguousarray(weight, dtype=np.float32)
+            arrays['{}.{}.bias'.format(name, i)] = np.ascontiguousarray(bias, dtype=np.float32)
+    with open(file_name, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+class NumpyPolicy:
+    def __init__(self, file_name):
+        '''
+        Load a policy file written by save_policy.
+        Params
+        ======
+            file_name (str): path to the .npz policy file
+        '''
+        with np.load(file_name, allow_pickle=False) as data:
+            self.meta = json.loads(data['meta'].tobytes().decode('utf-8'))
+            if self.meta['format_version'] != FORMAT_VERSION:
+                raise Exception('Unsupported policy format version {}'.format(self.meta['format_version']))
+            self.streams = {name: [(data['{}.{}.weight'.format(name, i)], data['{}.{}.bias'.format(name, i)])
+                    for i in range(num_layers)]
+                for name, num_layers in self.meta['streams'].items()}
+        self.network = self.meta['network']
+        self.state_size = self.meta['state_size']
+        self.action_size = self.meta['action_size']
+
+    def _forward(self, name, x):
+        '''
+            Run one stream of linear layers, with a relu after every layer but the last.
+        '''
+        layers = self.streams[name]
+        for weight, bias in layers[:-1]:
+            x = np.maximum(x @ weight + bias, 0.)
+        weight, bias = layers[-1]
+        return x @ weight + bias
+
+    def q_values(self, state):
+        '''
+            Action values for a state, or for a batch x state_size array of states.
+        '''
+        x = np.asarray(state, dtype=np.float32)
+        if self.network == 'DuelingQNetwork':
+            value = self._forward('value', x)
+            advantage = self._forward('advantage', x)
+            return value + (advantage - advantage.mean(axis=-1, keepdims=True))
+        return self._forward('q', x)
+
+    def act(self, state, eps=0.):
+        '''
+            Greedy action for a state, or an array of actions for a batch of states.
+            eps is accepted so that the policy can stand in for Agent.act, and is ignored.
+        '''
+        x = np.asarray(state, dtype=np.float32)
+        if self.network == 'DuelingQNetwork':
+            # the value stream and the mean advantage shift every action of a state
+            # by the same amount, so the advantages alone pick the greedy action
+            scores = self._forward('advantage', x)
+        else:
+            scores = self._forward('q', x)
+        actions = np.argmax(scores, axis=-1)
+        return int(actions) if actions.ndim == 0 else actions
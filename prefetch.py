@@ -0,0 +1,60 @@
+import queue
+import threading
+
+'''
+    Background sampling of replay batches.
+    Drawing the indices, gathering the transitions and copying them to the device
+    happen on a separate thread, so that the next batches are ready while the
+    current learn step runs its forward and backward passes.
+'''
+class PrefetchSampler:
+    def __init__(self, sample_fn, lock, num_batches=2):
+        '''
+        Params
+        ======
+            sample_fn (function): returns one batch, called on the background thread
+            lock (threading.Lock): held while sampling, and by whoever writes to the replay memory
+            num_batches (int): number of batches prepared ahead, 2 for double buffering
+        '''
+        self.sample_fn = sample_fn
+        self.lock = lock
+        self.batches = queue.Queue(maxsize=num_batches)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                with self.lock:
+                    batch = self.sample_fn()
+            except Exception as e:
+                # hand the error over to the learner, which re-raises it
+                batch = e
+            # wake up regularly to notice close() while the queue is full
+            while not self.stop_event.is_set():
+                try:
+                    self.batches.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(batch, Exception):
+                return
+
+    def get(self):
+        '''
+            Return the next prepared batch.  The thread is started on the first call,
+            when the replay memory is known to hold enough transitions to sample from.
+        '''
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        batch = self.batches.get()
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
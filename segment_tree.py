@@ -0,0 +1,92 @@
+import operator
+import numpy as np
+
+'''
+    Array backed segment trees used by the prioritized replay buffer.
+    Based on the sum-tree described in https://arxiv.org/pdf/1511.05952.pdf
+    (Prioritized Experience Replay, Appendix B.2.1), with every operation
+    vectorized over a batch of indices so that a learn step never loops in python.
+'''
+class SegmentTree:
+    def __init__(self, capacity, operation, scalar_operation, neutral_element):
+        '''
+        Build a tree with at least capacity leaves.
+        Params
+        ======
+            capacity (int): number of leaves needed, rounded up to a power of 2
+            operation (numpy ufunc): associative reduction used to combine two children
+            scalar_operation (function): the same reduction, for two python floats
+            neutral_element (float): identity of the operation, the value of an empty leaf
+        '''
+        self.capacity = 1
+        while self.capacity < capacity:
+            self.capacity *= 2
+        self.operation = operation
+        self.scalar_operation = scalar_operation
+        self.neutral_element = neutral_element
+        # node 1 is the root, the children of node i are 2i and 2i+1
+        # and the leaves occupy [capacity, 2*capacity)
+        self.tree = np.full(2 * self.capacity, neutral_element, dtype=np.float64)
+
+    def __setitem__(self, indices, values):
+        '''
+            Set the leaves at indices to values and recompute their ancestors, one tree level at a time.
+        '''
+        if np.isscalar(indices):
+            # a single leaf, as added at every environment step, is cheaper to update in python
+            node = int(indices) + self.capacity
+            tree = self.tree
+            tree[node] = values
+            reduce = self.scalar_operation
+            while node > 1:
+                node //= 2
+                tree[node] = reduce(tree[2 * node], tree[2 * node + 1])
+            return
+
+        nodes = np.asarray(indices, dtype=np.int64).reshape(-1) + self.capacity
+        self.tree[nodes] = values
+        # every leaf is at the same depth, so each pass handles exactly one level.
+        # siblings share a parent, which is then recomputed twice with the same value
+        while nodes[0] > 1:
+            nodes = nodes // 2
+            self.tree[nodes] = self.operation(self.tree[2 * nodes], self.tree[2 * nodes + 1])
+
+    def __getitem__(self, indices):
+        return self.tree[np.asarray(indices, dtype=np.int64) + self.capacity]
+
+    def reduce(self):
+        '''
+            Reduction over every leaf, kept up to date at the root.
+        '''
+        return self.tree[1]
+
+
+class SumSegmentTree(SegmentTree):
+    def __init__(self, capacity):
+        super().__init__(capacity, np.add, operator.add, 0.0)
+
+    def sum(self):
+        return self.reduce()
+
+    def find_prefixsum_idx(self, prefixsums):
+        '''
+            For each value v in prefixsums, find the highest leaf i such that
+            sum(leaves[:i]) <= v, walking down all the values at once.
+        '''
+        prefixsums = np.array(prefixsums, dtype=np.float64)
+        nodes = np.ones(len(prefixsums), dtype=np.int64)
+        while nodes[0] < self.capacity:
+            left = 2 * nodes
+            left_sums = self.tree[left]
+            go_right = prefixsums > left_sums
+            prefixsums = np.where(go_right, prefixsums - left_sums, prefixsums)
+            nodes = np.where(go_right, left + 1, left)
+        return nodes - self.capacity
+
+
+class MinSegmentTree(SegmentTree):
+    def __init__(self, capacity):
+        super().__init__(capacity, np.minimum, min, float('inf'))
+
+    def min(self):
+        return self.reduce()
@@ -0,0 +1,217 @@
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import time
+import numpy as np
+import torch
+from dqn_agent import Agent
+from vec_env import make_env
+from cpu_mode import configure_cpu, cpu_settings
+import train
+
+'''
+    Parallel hyper-parameter sweeps.
+    Each combination of the list valued config keys is a trial.  Trials run on a pool of
+    worker processes, each of which owns one environment for its whole life, and are pruned
+    with asynchronous successive halving (ASHA, https://arxiv.org/pdf/1810.05934.pdf) :
+    when a trial reaches a rung (min_episodes * eta^k episodes) it records its rolling mean
+    score there, and it only keeps training if it is in the top 1/eta of the trials that
+    have reached the same rung so far.
+'''
+ALGORITHMS = {
+    "double_dqn",
+    "prioritized_replay"
+}
+# keys whose value is itself a list, only a list of such lists is swept over
+LIST_VALUED = {
+    "replay_obs_range",
+}
+
+def expand_configs(info):
+    '''
+        Expand the list valued keys of a json configuration into the cartesian product of
+        their values, and turn the algorithms list of each combination into boolean flags.
+    '''
+    # make each of the items into a list if it isn't already, so that we can
+    # tune hyper parameters
+    hyper_config = {}
+    for k,v in info.items():
+        # create list if it isn't a list.  all other args should be scalars
+        if k in LIST_VALUED and type(v) == list and not any(type(item) == list for item in v):
+            v = [v]
+        hyper_config[k] = v if type(v) == list else [v]
+
+    configs = []
+    for values in itertools.product(*hyper_config.values()):
+        config = dict(zip(hyper_config.keys(), values))
+        # for each of the algorithms, create a key with the boolean flag if it's on
+        for algo in ALGORITHMS:
+            config[algo] = False
+
+        for algo in config['algorithms']:
+            config[algo] = True
+        configs.append(config)
+    return configs
+
+
+def rung_episodes(num_episodes, min_episodes, eta):
+    '''
+        Episodes at which trials are compared, min_episodes * eta^k below num_episodes.
+    '''
+    rungs = []
+    rung = min_episodes
+    while rung < num_episodes:
+        rungs.append(rung)
+        rung *= eta
+    return rungs
+
+
+class AshaPruner:
+    def __init__(self, rungs, eta, rung_scores, lock):
+        '''
+        Decide whether one trial keeps training, from the scores shared by every worker.
+        Params
+        ======
+            rungs (list): episodes at which the trial is compared to the others
+            eta (int): only the top 1/eta of the trials at a rung continue
+            rung_scores (multiprocessing.Manager dict): rung -> list of mean scores reported there
+            lock (multiprocessing.Manager Lock): guards rung_scores
+        '''
+        self.rungs = list(rungs)
+        self.eta = eta
+        self.rung_scores = rung_scores
+        self.lock = lock
+        self.history = {}
+        self.pruned = False
+
+    def __call__(self, i_episode, mean_score):
+        if not self.rungs or i_episode < self.rungs[0]:
+            return False
+        rung = self.rungs.pop(0)
+        self.history[rung] = float(mean_score)
+        with self.lock:
+            scores = self.rung_scores.get(rung, []) + [float(mean_score)]
+            self.rung_scores[rung] = scores
+        # keep going while too few trials have reached this rung to compare against
+        num_promoted = len(scores) // self.eta
+        if num_promoted == 0:
+            return False
+        self.pruned = bool(mean_score < sorted(scores, reverse=True)[num_promoted - 1])
+        return self.pruned
+
+
+# environment owned by each worker process, created by _init_worker
+_worker = {}
+
+def _init_worker(env_type, num_envs, file_name, seed, num_workers, worker_counter, counter_lock, cpu_config):
+    with counter_lock:
+        worker_id = worker_counter.value
+        worker_counter.value += 1
+    # share the cores between the workers instead of oversubscribing them
+    configure_cpu(cpu_config, worker_id, num_workers)
+    worker_seed = seed + worker_id
+    random.seed(worker_seed)
+    np.random.seed(worker_seed)
+    torch.manual_seed(worker_seed)
+    env, brain_name = make_env(env_type, num_envs, file_name, worker_id=worker_id, seed=worker_seed)
+    _worker.update(env=env, brain_name=brain_name, worker_id=worker_id)
+
+
+def _run_trial(args):
+    index, config, rungs, eta, rung_scores, lock = args
+    env = _worker['env']
+    brain_name = _worker['brain_name']
+    # every trial gets its own seed, so results do not depend on which worker ran it
+    random.seed(index)
+    np.random.seed(index)
+    torch.manual_seed(index)
+
+    pruner = AshaPruner(rungs, eta, rung_scores, lock)
+    save_name = '{}_{}.pth'.format(config['base_name'], index)
+    config = train.run_config(config, save_name)
+    start = time.time()
+    if brain_name is None:
+        states = env.reset(train_mode=True)
+        agent = Agent(state_size=states.shape[1], action_size=env.action_size, seed=index, config=config)
+        scores = train.dqn_vec(config, env, agent, save_name, episode_callback=pruner)
+    else:
+        env_info = env.reset(train_mode=True)[brain_name]
+        brain = env.brains[brain_name]
+        agent = Agent(state_size=len(env_info.vector_observations[0]), action_size=brain.vector_action_space_size,
+            seed=index, config=config)
+        scores = train.dqn(config, env, agent, brain_name, save_name, episode_callback=pruner)
+    agent.close()
+
+    means = [np.mean(scores[max(0, i + 1 - train.SCORE_WINDOW):i + 1]) for i in range(len(scores))]
+    return {
+        'index': index,
+        'config': config,
+        'save_name': save_name,
+        'worker_id': _worker['worker_id'],
+        'episodes': len(scores),
+        'pruned': pruner.pruned,
+        'rung_scores': pruner.history,
+        'final_mean_score': float(means[-1]) if means else None,
+        'best_mean_score': float(max(means)) if means else None,
+        'seconds': time.time() - start,
+    }
+
+
+def run_sweep(info, num_workers, file_name, min_episodes=train.SCORE_WINDOW, eta=3, seed=0):
+    '''
+        Run every trial of a json configuration on num_workers processes and write
+        a summary of the sweep to <base_name>_sweep.json.
+    Params
+    ======
+        info (dict): the json configuration, with list valued keys to sweep over
+        num_workers (int): number of worker processes, each with its own environment
+        file_name (str): path to the Unity executable, unused for the headless environment
+        min_episodes (int): episodes before the first pruning decision
+        eta (int): reduction factor, only the top 1/eta of the trials continue at each rung
+        seed (int): base of the per-worker seeds
+    '''
+    # checked before the workers start, which would otherwise fail one after the other
+    cpu_config = cpu_settings(info)
+    configs = expand_configs(info)
+    env_type = info['env'] if 'env' in info else 'unity'
+    num_envs = info['num_envs'] if 'num_envs' in info else 1
+
+    # spawn, so that workers do not inherit torch threads or sockets from the parent
+    context = multiprocessing.get_context('spawn')
+    manager = context.Manager()
+    rung_scores = manager.dict()
+    lock = manager.Lock()
+    worker_counter = manager.Value('i', 0)
+    tasks = [(i, config, rung_episodes(config['num_episodes'], min_episodes, eta), eta, rung_scores, lock)
+        for i, config in enumerate(configs)]
+
+    print('Sweeping {} trials on {} workers'.format(len(tasks), num_workers))
+    start = time.time()
+    results = []
+    with context.Pool(num_workers, initializer=_init_worker,
+            initargs=(env_type, num_envs, file_name, seed, num_workers, worker_counter, manager.Lock(),
+                cpu_config)) as pool:
+        # one trial at a time per worker, so that early trials fill the rungs first
+        for result in pool.imap_unordered(_run_trial, tasks, chunksize=1):
+            print('\nTrial {} {} after {} episodes, best mean score {:.2f}'.format(result['index'],
+                'pruned' if result['pruned'] else 'finished', result['episodes'], result['best_mean_score']))
+            results.append(result)
+
+    results.sort(key=lambda r: r['best_mean_score'], reverse=True)
+    summary = {
+        'num_trials': len(results),
+        'num_pruned': sum(r['pruned'] for r in results),
+        'num_workers': num_workers,
+        'eta': eta,
+        'min_episodes': min_episodes,
+        'seconds': time.time() - start,
+        'trials': results,
+    }
+    summary_name = '{}_sweep.json'.format(info['base_name'])
+    with open(summary_name, 'w') as f:
+        json.dump(summary, f, indent=4)
+    print('Sweep summary written to {}'.format(os.path.abspath(summary_name)))
+    manager.shutdown()
+    return summary
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from dqn_agent import ReplayBuffer
+
+'''
+    The replay buffer reads back what it was given, in every storage dtype and layout :
+        python -m pytest -q test_replay.py
+'''
+OBS_RANGE = (-3., 3.)
+# largest error of an observation read back, uint8 is quantized over OBS_RANGE
+TOLERANCE = {'float32': 0., 'float16': 2e-3, 'uint8': (OBS_RANGE[1] - OBS_RANGE[0]) / 255. / 2 + 1e-6}
+
+def _trajectory(rng, steps, state_size):
+    # the rewards of the environment are whole numbers, which a compact buffer stores as float16
+    states = rng.uniform(OBS_RANGE[0], OBS_RANGE[1], size=(steps + 1, state_size)).astype(np.float32)
+    states[0, :2] = OBS_RANGE
+    return states[:-1], rng.integers(0, 4, size=steps), rng.integers(-1, 2, size=steps).astype(np.float32), states[1:]
+
+
+@pytest.mark.parametrize('compact', [False, True])
+@pytest.mark.parametrize('obs_dtype', ['float32', 'float16', 'uint8'])
+def test_read_back(obs_dtype, compact):
+    rng = np.random.default_rng(0)
+    states, actions, rewards, next_states = _trajectory(rng, 12, 3)
+    dones = np.zeros(12, dtype=bool)
+    dones[-1] = True
+    memory = ReplayBuffer(4, 16, 4, 0, state_size=3, compact=compact, obs_dtype=obs_dtype, obs_range=OBS_RANGE)
+    # the first half one transition at a time, the rest as a batch of one environment copy
+    for i in range(6):
+        memory.add(states[i], actions[i], rewards[i], next_states[i], dones[i])
+    for i in range(6, 12):
+        memory.add_batch(states[i:i + 1], actions[i:i + 1], rewards[i:i + 1], next_states[i:i + 1], dones[i:i + 1])
+
+    read_states, read_actions, read_rewards, read_next_states, read_dones = memory._read(np.arange(12))
+    np.testing.assert_allclose(read_states, states, atol=TOLERANCE[obs_dtype])
+    np.testing.assert_allclose(read_next_states, next_states, atol=TOLERANCE[obs_dtype])
+    np.testing.assert_array_equal(np.reshape(read_actions, -1), actions)
+    np.testing.assert_allclose(np.reshape(read_rewards, -1), rewards)
+    np.testing.assert_array_equal(np.reshape(read_dones, -1), dones)
@@ -1,12 +1,100 @@
 from collections import deque
+import os
+import time
 import numpy as np
-import torch
 from sys import float_info
-from dqn_agent import Agent
+from dqn_agent import Agent, remove_replay
+from checkpoint import CheckpointWriter
+from trajectories import TrajectoryRecorder, remove_recording
+from cpu_mode import scale_batch
+from instrumentation import Telemetry, NULL_TELEMETRY
 
 SCORE_WINDOW = 100
 
-def dqn(config, env, agent, brain_name, save_name):
+def start_checkpoints(config, agent, save_name):
+    '''
+        Create the checkpoint writer of a run from the optional config keys
+            keep_top_k (int): number of best networks to keep, default 1
+            checkpoint_every (int): episodes between saves of the latest state, default 0 (never)
+            save_training_state (bool): save the optimizer and replay memory with the latest state
+            resume (bool): continue from the latest state of a previous run with the same save_name
+            compact_checkpoint (bool): also save the best network in the .ckpt format of checkpoint_format.py
+        return the writer, the last episode played, epsilon, the best rolling mean score and the scores so far
+    '''
+    checkpoints = CheckpointWriter(save_name, config,
+        keep_top_k=config['keep_top_k'] if 'keep_top_k' in config else 1,
+        checkpoint_every=config['checkpoint_every'] if 'checkpoint_every' in config else 0,
+        save_training_state=config['save_training_state'] if 'save_training_state' in config else False,
+        compact_checkpoint=config['compact_checkpoint'] if 'compact_checkpoint' in config else False)
+    resumed = checkpoints.resume(agent) if 'resume' in config and config['resume'] else None
+    if resumed is None:
+        resumed = 0, config['eps_start'], float_info.min, []
+    checkpoints.start(resumed[0] if resumed[0] > 0 else None)
+    return (checkpoints,) + tuple(resumed)
+
+def run_config(config, save_name):
+    '''
+        Configuration of the run saved to save_name.  With the optional config keys replay_dir
+        and record_dir, every run keeps its disk-backed replay buffer in its own <replay_dir>/<save_name>
+        directory, and records its trajectories to <record_dir>/<save_name>.  A resumed run reopens its
+        replay buffer and continues its recording, a new run deletes the ones left there by an earlier run
+        with the same save_name.
+        With batch_scale, the batch size, learning rate and learning interval are scaled, see cpu_mode.py.
+    '''
+    config = scale_batch(config)
+    stem = os.path.splitext(os.path.basename(save_name))[0]
+    for key in ('replay_dir', 'record_dir'):
+        if key in config and config[key]:
+            config = dict(config, **{key: os.path.join(config[key], stem)})
+    if 'replay_dir' in config and config['replay_dir'] and not ('resume' in config and config['resume']):
+        warm_start = config['replay_warm_start'] if 'replay_warm_start' in config else None
+        if warm_start and os.path.abspath(warm_start) == os.path.abspath(config['replay_dir']):
+            raise Exception('{} is the replay_dir of this run, which a new run starts over, '
+                'move it elsewhere to warm start from it'.format(warm_start))
+        if os.path.isdir(config['replay_dir']):
+            remove_replay(config['replay_dir'])
+    if 'record_dir' in config and config['record_dir'] and not ('resume' in config and config['resume']):
+        if os.path.isdir(config['record_dir']):
+            remove_recording(config['record_dir'])
+    return config
+
+def start_recorder(config, agent):
+    '''
+        Record the experiences of the agent to the directory of the optional config key record_dir,
+        in shards of record_shard_size transitions (default 50000) with record_obs_dtype states
+        ("float32" or "float16"), see trajectories.py.
+        return the recorder, None when record_dir is not set
+    '''
+    if 'record_dir' not in config or not config['record_dir']:
+        return None
+    agent.recorder = TrajectoryRecorder(config['record_dir'], agent.state_size, agent.action_size,
+        shard_size=config['record_shard_size'] if 'record_shard_size' in config else 50000,
+        obs_dtype=config['record_obs_dtype'] if 'record_obs_dtype' in config else 'float32', config=config)
+    return agent.recorder
+
+def stop_recorder(agent):
+    if agent.recorder is not None:
+        agent.recorder.close()
+        agent.recorder = None
+
+def start_telemetry(config, agent, save_name, telemetry):
+    '''
+        Attach the telemetry of a run to the agent.  Unless one is given, it is recorded to
+        <save_name>_telemetry.jsonl when the optional config key telemetry is true, and off otherwise.
+        A resumed run appends to the records of the run it continues, a new run starts the file over.
+        return the telemetry, and whether this run owns it (and must close it)
+    '''
+    if telemetry is not None:
+        agent.telemetry = telemetry
+        return telemetry, False
+    if 'telemetry' in config and config['telemetry']:
+        agent.telemetry = Telemetry('{}_telemetry.jsonl'.format(os.path.splitext(save_name)[0]),
+            append='resume' in config and config['resume'])
+        return agent.telemetry, True
+    agent.telemetry = NULL_TELEMETRY
+    return NULL_TELEMETRY, False
+
+def dqn(config, env, agent, brain_name, save_name, episode_callback=None, telemetry=None):
     """Deep Q-Learning.
     Params
     ======
@@ -15,20 +103,29 @@ def dqn(config, env, agent, brain_name, save_name):
         eps_start (float): starting value of epsilon, for epsilon-greedy action selection
         eps_end (float): minimum value of epsilon
         eps_decay (float): multiplicative factor (per episode) for decreasing epsilon
+        episode_callback (function): called as episode_callback(i_episode, mean_score) after each
+            episode, training stops early when it returns True
+        telemetry (instrumentation.Telemetry): records the time spent in each phase, see start_telemetry
     """
-    scores = []                        # list containing scores from each episode
-    scores_window = deque(maxlen=SCORE_WINDOW)  # last 100 scores
-    eps = config['eps_start']          # initialize epsilon
-    max_score = float_info.min
-    for i_episode in range(1, config['num_episodes']+1):        
+    telemetry, own_telemetry = start_telemetry(config, agent, save_name, telemetry)
+    # scores (list containing scores from each episode), epsilon and the best score,
+    # either new or from the run being resumed
+    checkpoints, last_episode, eps, max_score, scores = start_checkpoints(config, agent, save_name)
+    scores_window = deque(scores[-SCORE_WINDOW:], maxlen=SCORE_WINDOW)  # last 100 scores
+    start_recorder(config, agent)
+    start_time = time.time()
+    for i_episode in range(last_episode+1, config['num_episodes']+1):        
         env_info = env.reset(train_mode=True)[brain_name]
         state = env_info.vector_observations[0] 
         score = 0
-        for _ in range(config['max_time']):
+        for steps in range(1, config['max_time'] + 1):
             # get an action from the agent
-            action = agent.act(state, eps)
+            with telemetry.timer('act'):
+                action = agent.act(state, eps)
             # update the environment with this action
-            env_info = env.step(action)[brain_name]
+            with telemetry.timer('env_step'):
+                env_info = env.step(action)[brain_name]
+            telemetry.count('steps')
             next_state = env_info.vector_observations[0]   # get the next state
             reward = env_info.rewards[0]                   # get the reward
             done = env_info.local_done[0]                  # see if episode has finished
@@ -40,21 +137,106 @@ def dqn(config, env, agent, brain_name, save_name):
                 break 
         scores_window.append(score)       # save most recent score
         scores.append(score)              # save most recent score
+        mean_score = np.mean(scores_window)
+        loss, updates = agent.pop_loss()
+        checkpoints.append_episode(episode=i_episode, score=score, mean_score=mean_score, eps=eps, steps=steps,
+            updates=updates, loss=loss, wall_time=time.time() - start_time)
 
         eps = max(config['eps_end'], config['eps_decay']*eps) # decrease epsilon
-        mean_score = np.mean(scores_window)
         print('\rEpisode {}\tAverage Score: {:.2f}'.format(i_episode, mean_score), end="")
         if i_episode % SCORE_WINDOW == 0:
             print('\rEpisode {}\tAverage Score: {:.2f}'.format(i_episode, mean_score))
         
-        if mean_score > max_score:
-            max_score = mean_score
-            torch.save({
-                    'net': agent.qnetwork_local.state_dict(), 
-                    'config': config,
-                    'scores': scores,
-                },
-                save_name)
+        with telemetry.timer('checkpoint'):
+            if mean_score > max_score:
+                max_score = mean_score
+                checkpoints.save_best(agent, i_episode, mean_score)
+            checkpoints.save_latest(agent, i_episode, mean_score, max_score, eps)
+        telemetry.end_episode(i_episode, agent, score=score, mean_score=mean_score, eps=eps)
+
+        if episode_callback is not None and episode_callback(i_episode, mean_score):
+            break
+    if len(scores) > 0:
+        checkpoints.save_latest(agent, len(scores), np.mean(scores_window), max_score, eps, force=True)
+    checkpoints.close()
+    stop_recorder(agent)
+    if own_telemetry:
+        telemetry.close()
+    return scores
+
+
+def dqn_vec(config, vec_env, agent, save_name, episode_callback=None, telemetry=None):
+    """Deep Q-Learning on num_envs environment copies stepped in lockstep.
+    Each iteration runs one episode in every copy, so num_episodes is counted
+    in single-environment episodes, and epsilon decays once for each of them.
+    Params
+    ======
+        config (dict): training configuration, the same keys as dqn
+        vec_env (vec_env.HeadlessBananaEnv or vec_env.UnityVecEnv): batched environment
+        agent (Agent): agent to train
+        save_name (str): file name of the saved network
+        episode_callback (function): called as episode_callback(i_episode, mean_score) after each
+            iteration, training stops early when it returns True
+        telemetry (instrumentation.Telemetry): records the time spent in each phase, see start_telemetry
+    """
+    telemetry, own_telemetry = start_telemetry(config, agent, save_name, telemetry)
+    checkpoints, i_episode, eps, max_score, scores = start_checkpoints(config, agent, save_name)
+    scores_window = deque(scores[-SCORE_WINDOW:], maxlen=SCORE_WINDOW)
+    start_recorder(config, agent)
+    start_time = time.time()
+    num_envs = vec_env.num_envs
+    while i_episode < config['num_episodes']:
+        states = vec_env.reset(train_mode=True)
+        episode_scores = np.zeros(num_envs)
+        # copies that finish early stop contributing transitions until the next reset
+        active = np.ones(num_envs, dtype=bool)
+        episode_steps = np.zeros(num_envs, dtype=np.int64)
+        for _ in range(config['max_time']):
+            with telemetry.timer('act'):
+                actions = agent.act(states, eps)
+            with telemetry.timer('env_step'):
+                next_states, rewards, dones = vec_env.step(actions)
+            telemetry.count('steps', int(active.sum()))
+            agent.step_batch(states[active], actions[active], rewards[active], next_states[active], dones[active])
+            episode_scores += rewards * active
+            episode_steps += active
+            active &= ~dones
+            states = next_states
+            if not active.any():
+                break
+        # the copies share the epsilon and the updates of the iteration
+        loss, updates = agent.pop_loss()
+        wall_time = time.time() - start_time
+        for copy, (score, steps) in enumerate(zip(episode_scores, episode_steps)):
+            i_episode += 1
+            scores_window.append(score)
+            scores.append(float(score))
+            # the updates of the iteration are counted once, on the row of its last copy
+            last = copy == num_envs - 1
+            checkpoints.append_episode(episode=i_episode, score=score, mean_score=np.mean(scores_window), eps=eps, steps=steps,
+                updates=updates if last else 0, loss=loss if last else np.nan, wall_time=wall_time)
+
+        eps = max(config['eps_end'], (config['eps_decay'] ** num_envs) * eps)
+        mean_score = np.mean(scores_window)
+        print('\rEpisode {}\tAverage Score: {:.2f}'.format(i_episode, mean_score), end="")
+        if i_episode % SCORE_WINDOW < num_envs:
+            print('\rEpisode {}\tAverage Score: {:.2f}'.format(i_episode, mean_score))
+
+        with telemetry.timer('checkpoint'):
+            if mean_score > max_score:
+                max_score = mean_score
+                checkpoints.save_best(agent, i_episode, mean_score)
+            checkpoints.save_latest(agent, i_episode, mean_score, max_score, eps)
+        telemetry.end_episode(i_episode, agent, scores=episode_scores.tolist(), mean_score=mean_score, eps=eps)
+
+        if episode_callback is not None and episode_callback(i_episode, mean_score):
+            break
+    if len(scores) > 0:
+        checkpoints.save_latest(agent, len(scores), np.mean(scores_window), max_score, eps, force=True)
+    checkpoints.close()
+    stop_recorder(agent)
+    if own_telemetry:
+        telemetry.close()
     return scores
 
 
@@ -78,4 +260,20 @@ def run(env, agent, brain_name):
         state = next_state                             # roll over the state to next time step
         if done:                                       # exit loop if episode finished
             break
-    print('Final Score {}'.format(score))
\ No newline at end of file
+    print('Final Score {}'.format(score))
+
+
+def run_vec(vec_env, agent):
+    '''
+        Run an agent for one episode on every copy of a batched environment
+    '''
+    states = vec_env.reset(train_mode=False)
+    scores = np.zeros(vec_env.num_envs)
+    active = np.ones(vec_env.num_envs, dtype=bool)
+    while active.any():
+        actions = agent.act(states)
+        states, rewards, dones = vec_env.step(actions)
+        scores += rewards * active
+        active &= ~dones
+    print('Final Scores {}, mean {:.2f}'.format(scores.tolist(), np.mean(scores)))
+    return scores
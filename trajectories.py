@@ -0,0 +1,331 @@
+import argparse
+import glob
+import json
+import os
+import queue
+import threading
+import time
+import numpy as np
+
+'''
+    Recorded experience, for training without the environment.
+
+    A TrajectoryRecorder attached to an agent (see train.start_recorder) keeps every
+    (state, action, reward, next_state, done) tuple passed to Agent.step and Agent.step_batch,
+    and writes them to compressed shards of shard_size transitions,
+        <directory>/shard_000000.npz, shard_000001.npz, ...
+    on a background thread.  trajectories.json lists the shards with their number of transitions
+    and episodes, and is updated after each shard, so a recording interrupted at any point is usable.
+
+    The shards are read back as a stream : stream_batches yields shuffled batches while holding
+    only a few shards in memory, fill_replay adds them to a replay buffer, and pretrain runs
+    Agent.learn on them directly :
+        python trajectories.py info recordings/run_0
+        python trajectories.py pretrain config.json recordings/run_0 --epochs 2 --save pretrained.pth
+'''
+MANIFEST_FILE = 'trajectories.json'
+FORMAT_VERSION = 1
+# the fields of a shard, rows holds the row of each transition in its call to Agent.step_batch (0 for Agent.step)
+SHARD_FIELDS = ('states', 'actions', 'rewards', 'next_states', 'dones', 'rows')
+
+def read_manifest(directory):
+    '''
+        Description of the recording in directory, None if there is none.
+    '''
+    file_name = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name) as f:
+        manifest = json.load(f)
+    if manifest['format_version'] != FORMAT_VERSION:
+        raise Exception('Unsupported trajectory format version {} in {}'.format(manifest['format_version'], file_name))
+    return manifest
+
+
+def remove_recording(directory):
+    '''
+        Delete the recording in directory, its manifest first so that it is never seen half removed.
+    '''
+    file_name = os.path.join(directory, MANIFEST_FILE)
+    if os.path.exists(file_name):
+        os.remove(file_name)
+    for file_name in glob.glob(os.path.join(directory, 'shard_*.npz')):
+        os.remove(file_name)
+
+
+class TrajectoryRecorder:
+    def __init__(self, directory, state_size, action_size, shard_size=50000, obs_dtype='float32', config=None):
+        '''
+        Params
+        ======
+            directory (str): directory of the shards, a recording already there is continued
+            state_size (int): dimension of each state
+            action_size (int): number of actions
+            shard_size (int): transitions per shard
+            obs_dtype (str): storage of the states, "float32" or "float16"
+            config (dict): training configuration, stored in the manifest
+        '''
+        self.directory = directory
+        self.shard_size = int(shard_size)
+        self.obs_dtype = np.dtype(obs_dtype)
+        if self.obs_dtype not in (np.float32, np.float16):
+            raise Exception('Unsupported observation dtype {}'.format(obs_dtype))
+        os.makedirs(directory, exist_ok=True)
+        self.manifest = read_manifest(directory)
+        if self.manifest is None:
+            self.manifest = {'format_version': FORMAT_VERSION, 'state_size': state_size, 'action_size': action_size,
+                'config': config, 'shards': []}
+        elif self.manifest['state_size'] != state_size or self.manifest['action_size'] != action_size:
+            raise Exception('{} holds trajectories with {} states and {} actions, expected {} and {}'.format(directory,
+                self.manifest['state_size'], self.manifest['action_size'], state_size, action_size))
+        # transitions added since the last shard, one tuple of arrays per call
+        self.parts = []
+        self.count = 0
+
+        # at most two shards wait to be compressed, which bounds the memory when the disk is slow
+        self.jobs = queue.Queue(maxsize=2)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            shard = self.jobs.get()
+            if shard is None:
+                return
+            try:
+                self._write(shard)
+            except Exception as e:
+                # raised on the training thread by the next flush
+                self.error = e
+
+    def _write(self, shard):
+        name = 'shard_{:06d}.npz'.format(len(self.manifest['shards']))
+        file_name = os.path.join(self.directory, name)
+        temporary = file_name + '.tmp'
+        with open(temporary, 'wb') as f:
+            np.savez_compressed(f, **shard)
+        os.replace(temporary, file_name)
+        self.manifest['shards'].append({'file': name, 'transitions': len(shard['states']),
+            'episodes': int(shard['dones'].sum())})
+        self.manifest['updated'] = time.time()
+        manifest_file = os.path.join(self.directory, MANIFEST_FILE)
+        with open(manifest_file + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(manifest_file + '.tmp', manifest_file)
+
+    def add(self, state, action, reward, next_state, done):
+        self.add_batch(np.reshape(state, (1, -1)), [action], [reward], np.reshape(next_state, (1, -1)), [done])
+
+    def add_batch(self, states, actions, rewards, next_states, dones):
+        n = len(states)
+        # copies, the caller is free to reuse its arrays
+        self.parts.append((np.array(states, dtype=self.obs_dtype), np.reshape(actions, n).astype(np.uint8),
+            np.reshape(rewards, n).astype(np.float32), np.array(next_states, dtype=self.obs_dtype),
+            np.reshape(dones, n).astype(bool), np.arange(n, dtype=np.uint16)))
+        self.count += n
+        if self.count >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        '''
+            Queue the transitions added so far as a shard.
+        '''
+        if self.error is not None:
+            raise self.error
+        if self.count == 0:
+            return
+        self.jobs.put({name: np.concatenate(field) for name, field in zip(SHARD_FIELDS, zip(*self.parts))})
+        self.parts = []
+        self.count = 0
+
+    def close(self):
+        '''
+            Write the remaining transitions, and wait for every shard to be written.
+        '''
+        self.flush()
+        self.jobs.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def list_shards(sources):
+    '''
+        Shards of one or more recordings, in the order they were written.
+    Params
+    ======
+        sources (str or list): recording directories
+    return a list of (shard file, number of transitions) and the manifest of the first recording
+    '''
+    sources = [sources] if isinstance(sources, str) else list(sources)
+    shards = []
+    first = None
+    for directory in sources:
+        manifest = read_manifest(directory)
+        if manifest is None:
+            raise Exception('{} holds no recorded trajectories'.format(directory))
+        if first is None:
+            first = manifest
+        elif manifest['state_size'] != first['state_size'] or manifest['action_size'] != first['action_size']:
+            raise Exception('{} holds trajectories with {} states and {} actions, expected {} and {}'.format(directory,
+                manifest['state_size'], manifest['action_size'], first['state_size'], first['action_size']))
+        shards.extend((os.path.join(directory, shard['file']), shard['transitions']) for shard in manifest['shards'])
+    return shards, first
+
+
+def read_shard(file_name):
+    '''
+        The transitions of a shard, as (s, a, r, s', done) arrays in the dtypes Agent.learn expects,
+        and the row of each transition in its call to Agent.step_batch.
+    '''
+    with np.load(file_name) as shard:
+        return ((shard['states'].astype(np.float32), shard['actions'].astype(np.int64).reshape(-1, 1),
+            shard['rewards'].reshape(-1, 1), shard['next_states'].astype(np.float32),
+            shard['dones'].astype(np.float32).reshape(-1, 1)), shard['rows'])
+
+
+def stream_batches(sources, batch_size, epochs=1, shards_in_memory=4, shuffle=True, seed=0, drop_last=True):
+    '''
+        Generator of batches of recorded transitions, as (s, a, r, s', done) numpy arrays.
+        The shards are visited in a random order, shards_in_memory at a time, and the transitions
+        of the shards in memory are shuffled together, so that a batch mixes several shards
+        while the memory used stays bounded.
+    Params
+    ======
+        sources (str or list): recording directories
+        batch_size (int): transitions per batch
+        epochs (int): passes over the recordings, None to cycle through them forever
+        shards_in_memory (int): shards decompressed at a time
+        shuffle (bool): shuffle the shards and the transitions, otherwise they come in recorded order
+        seed (int): random seed of the shuffling
+        drop_last (bool): skip the last batch of an epoch when it is smaller than batch_size
+    '''
+    shards, _ = list_shards(sources)
+    if not shards:
+        return
+    rng = np.random.RandomState(seed)
+    epoch = 0
+    while epochs is None or epoch < epochs:
+        epoch += 1
+        order = rng.permutation(len(shards)) if shuffle else np.arange(len(shards))
+        # transitions carried over to the next group, fewer than batch_size
+        leftover = None
+        for start in range(0, len(order), shards_in_memory):
+            fields = [read_shard(shards[i][0])[0] for i in order[start:start + shards_in_memory]]
+            if leftover is not None:
+                fields.append(leftover)
+            fields = tuple(np.concatenate(field) for field in zip(*fields))
+            n = len(fields[0])
+            indices = rng.permutation(n) if shuffle else np.arange(n)
+            full = n - n % batch_size
+            for i in range(0, full, batch_size):
+                yield tuple(field[indices[i:i + batch_size]] for field in fields)
+            leftover = tuple(field[indices[full:]] for field in fields)
+        if not drop_last and leftover is not None and len(leftover[0]) > 0:
+            yield leftover
+
+
+def fill_replay(memory, sources, limit=None):
+    '''
+        Add recorded transitions to a replay buffer, in the order they were recorded,
+        so that a compact buffer shares the observations along each trajectory.
+    Params
+    ======
+        memory (dqn_agent.ReplayBuffer): buffer to fill
+        sources (str or list): recording directories
+        limit (int): add only the most recent limit transitions, all of them when None
+    return the number of transitions added
+    '''
+    shards, _ = list_shards(sources)
+    skip = max(0, sum(count for _, count in shards) - limit) if limit is not None else 0
+    added = 0
+    for file_name, count in shards:
+        if skip >= count:
+            skip -= count
+            continue
+        fields, rows = read_shard(file_name)
+        fields = tuple(field[skip:] for field in fields)
+        rows = rows[skip:]
+        skip = 0
+        if memory.compact:
+            # replay the calls to Agent.step_batch, each one starts at row 0
+            starts = list(np.flatnonzero(rows == 0)) + [len(rows)]
+            if starts[0] != 0:
+                starts.insert(0, 0)
+            for begin, end in zip(starts[:-1], starts[1:]):
+                memory.add_batch(*(field[begin:end] for field in fields))
+        else:
+            # the buffer wraps around, so only its last buffer_size transitions are added
+            fields = tuple(field[-memory.buffer_size:] for field in fields)
+            memory.add_batch(*fields)
+        added += len(rows)
+    return added
+
+
+def pretrain(agent, sources, epochs=1, batch_size=None, shards_in_memory=4, seed=0):
+    '''
+        Train an agent on recorded transitions, calling Agent.learn on each batch, with no replay buffer in between.
+    Params
+    ======
+        agent (dqn_agent.Agent): agent to train, its batch_size and gamma are used
+        sources (str or list): recording directories
+        epochs (int): passes over the recordings
+        batch_size (int): transitions per update, defaults to the batch_size of the agent
+    return the number of updates and their mean loss
+    '''
+    import torch
+    from dqn_agent import device
+    batch_size = batch_size if batch_size is not None else agent.config['batch_size']
+    updates = 0
+    for batch in stream_batches(sources, batch_size, epochs=epochs, shards_in_memory=shards_in_memory, seed=seed):
+        experiences = tuple(torch.from_numpy(field).to(device) for field in batch)
+        # without replay indices, prioritized agents learn with uniform weights
+        agent.learn(experiences, None, agent.config['gamma'])
+        updates += 1
+    loss, _ = agent.pop_loss()
+    return updates, loss
+
+
+parser = argparse.ArgumentParser(description="Inspect recorded trajectories, and train on them without the environment")
+subparsers = parser.add_subparsers(dest='command')
+info_parser = subparsers.add_parser('info', help="Describe recordings.")
+info_parser.add_argument('directories', nargs='+', help="Recording directories.")
+pretrain_parser = subparsers.add_parser('pretrain', help="Train a network on recordings.")
+pretrain_parser.add_argument('config', help="Json configuration of the agent, the first combination is used.")
+pretrain_parser.add_argument('directories', nargs='+', help="Recording directories.")
+pretrain_parser.add_argument('--epochs', type=int, default=1, help="Passes over the recordings.")
+pretrain_parser.add_argument('--shards-in-memory', type=int, default=4, help="Shards decompressed at a time.")
+pretrain_parser.add_argument('--seed', type=int, default=0, help="Random seed of the agent and of the shuffling.")
+pretrain_parser.add_argument('--save', default='pretrained.pth', help="File the trained network is saved to.")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.command == 'info':
+        for directory in args.directories:
+            shards, manifest = list_shards(directory)
+            sizes = [os.path.getsize(file_name) for file_name, _ in shards]
+            transitions = sum(count for _, count in shards)
+            print('{}: {} shards, {} transitions, {} episodes, {:.1f} MB ({:.1f} bytes per transition)'.format(directory,
+                len(shards), transitions, sum(shard['episodes'] for shard in manifest['shards']),
+                sum(sizes) / 2**20, sum(sizes) / max(transitions, 1)))
+    elif args.command == 'pretrain':
+        import torch
+        from dqn_agent import Agent
+        from sweep import expand_configs
+        from cpu_mode import configure_cpu, scale_batch
+        with open(args.config) as f:
+            config = scale_batch(expand_configs(json.load(f))[0])
+        configure_cpu(config)
+        _, manifest = list_shards(args.directories)
+        agent = Agent(state_size=manifest['state_size'], action_size=manifest['action_size'], seed=args.seed,
+            config=dict(config, replay_dir=None, replay_warm_start=None))
+        start = time.time()
+        updates, loss = pretrain(agent, args.directories, epochs=args.epochs, shards_in_memory=args.shards_in_memory, seed=args.seed)
+        elapsed = time.time() - start
+        print('{} updates in {:.1f}s ({:.0f} per second), mean loss {:.5f}'.format(updates, elapsed, updates / max(elapsed, 1e-9), loss))
+        torch.save({'net': agent.qnetwork_local.state_dict(), 'config': config, 'pretrained_on': args.directories}, args.save)
+        agent.close()
+        print('Network saved to {}'.format(args.save))
+    else:
+        parser.print_help()
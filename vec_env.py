@@ -0,0 +1,197 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+'''
+    Batched environments that step N copies of the banana task in lockstep.
+    Every environment exposes the same small interface used by train.dqn_vec :
+        reset(train_mode) -> states (num_envs x state_size)
+        step(actions)     -> next_states, rewards, dones (each with num_envs rows)
+        close()
+    along with the num_envs, state_size and action_size attributes.
+'''
+STATE_SIZE = 37
+ACTION_SIZE = 4
+
+class UnityVecEnv:
+    def __init__(self, file_name, num_envs, base_worker_id=0, no_graphics=True):
+        '''
+        Launch num_envs copies of a Unity environment, each on its own port.
+        Params
+        ======
+            file_name (str): path to the Unity executable
+            num_envs (int): number of environment copies
+            base_worker_id (int): worker id of the first copy, the others use the next ids
+            no_graphics (bool): run the copies without rendering
+        '''
+        # imported here, so that the headless environment does not need unityagents
+        from unityagents import UnityEnvironment
+
+        self.num_envs = num_envs
+        self.envs = [UnityEnvironment(file_name=file_name, worker_id=base_worker_id + i, no_graphics=no_graphics)
+            for i in range(num_envs)]
+        self.brain_names = [env.brain_names[0] for env in self.envs]
+        self.action_size = self.envs[0].brains[self.brain_names[0]].vector_action_space_size
+        self.state_size = None
+        # each step is a blocking rpc to a separate process, so threads overlap the waits
+        self.pool = ThreadPoolExecutor(max_workers=num_envs)
+
+    def _collect(self, env_infos):
+        states = np.stack([info.vector_observations[0] for info in env_infos])
+        rewards = np.array([info.rewards[0] for info in env_infos], dtype=np.float32)
+        dones = np.array([info.local_done[0] for info in env_infos], dtype=bool)
+        return states, rewards, dones
+
+    def reset(self, train_mode=True):
+        env_infos = list(self.pool.map(
+            lambda i: self.envs[i].reset(train_mode=train_mode)[self.brain_names[i]], range(self.num_envs)))
+        states, _, _ = self._collect(env_infos)
+        self.state_size = states.shape[1]
+        return states
+
+    def step(self, actions):
+        env_infos = list(self.pool.map(
+            lambda i: self.envs[i].step(int(actions[i]))[self.brain_names[i]], range(self.num_envs)))
+        return self._collect(env_infos)
+
+    def close(self):
+        self.pool.shutdown()
+        for env in self.envs:
+            env.close()
+
+
+class HeadlessBananaEnv:
+    '''
+        Pure numpy stand-in for the Unity banana collector, with the same 37 dimensional
+        observation and 4 discrete actions, so that training runs on machines without the
+        Unity binary.  All num_envs copies are simulated together with array operations.
+
+        The agent moves in a square arena scattered with yellow (+1) and blue (-1) bananas.
+        The observation is made of 7 rays, each encoded as
+        [yellow banana, wall, blue banana, agent, distance] like the Unity ray perception,
+        followed by the forward and angular velocity of the agent.
+    '''
+    # ray directions in degrees, relative to the agent, 90 is straight ahead
+    RAY_ANGLES = np.radians([20., 90., 160., 45., 135., 70., 110.])
+
+    def __init__(self, num_envs=1, seed=0, max_steps=300, num_bananas=30, arena_size=10.,
+            yellow_fraction=0.6, ray_length=10., banana_radius=0.5):
+        '''
+        Params
+        ======
+            num_envs (int): number of environment copies
+            seed (int): random seed
+            max_steps (int): episode length, the Unity episodes are 300 steps long
+            num_bananas (int): bananas in each arena, a collected banana respawns somewhere else
+            arena_size (float): half width of the square arena
+            yellow_fraction (float): probability that a spawned banana is yellow
+            ray_length (float): maximum distance seen by a ray
+            banana_radius (float): radius used both to collect bananas and to hit them with rays
+        '''
+        self.num_envs = num_envs
+        self.state_size = STATE_SIZE
+        self.action_size = ACTION_SIZE
+        self.max_steps = max_steps
+        self.num_bananas = num_bananas
+        self.arena_size = arena_size
+        self.yellow_fraction = yellow_fraction
+        self.ray_length = ray_length
+        self.banana_radius = banana_radius
+        self.rng = np.random.RandomState(seed)
+
+        self.acceleration = 0.2
+        self.damping = 0.7
+        self.turn_rate = np.radians(15.)
+
+    def _spawn(self, shape):
+        positions = self.rng.uniform(-self.arena_size, self.arena_size, size=shape + (2,))
+        yellow = self.rng.random_sample(shape) < self.yellow_fraction
+        return positions, yellow
+
+    def reset(self, train_mode=True):
+        n = self.num_envs
+        self.t = 0
+        self.position = np.zeros((n, 2))
+        self.heading = self.rng.uniform(0., 2 * np.pi, size=n)
+        self.speed = np.zeros(n)
+        self.angular_speed = np.zeros(n)
+        self.bananas, self.yellow = self._spawn((n, self.num_bananas))
+        return self._observe()
+
+    def step(self, actions):
+        actions = np.asarray(actions).reshape(self.num_envs)
+        # 0 forward, 1 backward, 2 turn left, 3 turn right
+        thrust = np.where(actions == 0, 1., np.where(actions == 1, -1., 0.))
+        turn = np.where(actions == 2, 1., np.where(actions == 3, -1., 0.))
+        self.speed = self.damping * self.speed + self.acceleration * thrust
+        self.angular_speed = turn * self.turn_rate
+        self.heading = (self.heading + self.angular_speed) % (2 * np.pi)
+        direction = np.stack([np.cos(self.heading), np.sin(self.heading)], axis=1)
+        self.position = np.clip(self.position + self.speed[:, None] * direction, -self.arena_size, self.arena_size)
+
+        # collect every banana within reach and respawn it
+        distances = np.linalg.norm(self.bananas - self.position[:, None, :], axis=2)
+        collected = distances < self.banana_radius
+        rewards = np.sum(np.where(self.yellow, 1., -1.) * collected, axis=1).astype(np.float32)
+        if collected.any():
+            positions, yellow = self._spawn((int(collected.sum()),))
+            self.bananas[collected] = positions
+            self.yellow[collected] = yellow
+
+        self.t += 1
+        dones = np.full(self.num_envs, self.t >= self.max_steps, dtype=bool)
+        return self._observe(), rewards, dones
+
+    def _observe(self):
+        n = self.num_envs
+        angles = self.heading[:, None] + self.RAY_ANGLES[None, :] - np.pi / 2
+        # n x rays x 2
+        rays = np.stack([np.cos(angles), np.sin(angles)], axis=2)
+
+        # distance along each ray to the closest banana it intersects, n x rays x bananas
+        relative = self.bananas - self.position[:, None, :]
+        projection = np.einsum('nrd,nkd->nrk', rays, relative)
+        perpendicular = np.sum(relative ** 2, axis=2)[:, None, :] - projection ** 2
+        half_chord = np.sqrt(np.maximum(self.banana_radius ** 2 - perpendicular, 0.))
+        hit = (projection > 0) & (perpendicular < self.banana_radius ** 2)
+        banana_distance = np.where(hit, projection - half_chord, np.inf)
+        nearest = np.argmin(banana_distance, axis=2)
+        banana_distance = np.take_along_axis(banana_distance, nearest[..., None], axis=2)[..., 0]
+        nearest_yellow = np.take_along_axis(
+            np.broadcast_to(self.yellow[:, None, :], banana_distance.shape + (self.num_bananas,)),
+            nearest[..., None], axis=2)[..., 0]
+
+        # distance along each ray to the arena wall
+        with np.errstate(divide='ignore'):
+            bound = np.where(rays > 0, self.arena_size, -self.arena_size)
+            wall_distance = np.where(rays != 0, (bound - self.position[:, None, :]) / rays, np.inf).min(axis=2)
+
+        distance = np.minimum(np.minimum(banana_distance, wall_distance), self.ray_length)
+        sees_banana = (banana_distance <= wall_distance) & (banana_distance < self.ray_length)
+        sees_wall = ~sees_banana & (wall_distance < self.ray_length)
+
+        observation = np.zeros((n, len(self.RAY_ANGLES), 5), dtype=np.float32)
+        observation[..., 0] = sees_banana & nearest_yellow
+        observation[..., 1] = sees_wall
+        observation[..., 2] = sees_banana & ~nearest_yellow
+        observation[..., 4] = distance / self.ray_length
+        velocity = np.stack([self.speed, self.angular_speed / self.turn_rate], axis=1).astype(np.float32)
+        return np.concatenate([observation.reshape(n, -1), velocity], axis=1)
+
+    def close(self):
+        pass
+
+
+def make_env(env_type, num_envs, file_name, worker_id=0, seed=0):
+    '''
+        Create the training environment selected by the "env" and "num_envs" config keys.
+        return the environment and the name of its brain, which is None for the batched
+            environments that are trained with train.dqn_vec instead of train.dqn
+    '''
+    if env_type == 'headless':
+        return HeadlessBananaEnv(num_envs=num_envs, seed=seed), None
+    if num_envs > 1:
+        return UnityVecEnv(file_name, num_envs, base_worker_id=worker_id * num_envs), None
+
+    from unityagents import UnityEnvironment
+    env = UnityEnvironment(file_name=file_name, worker_id=worker_id)
+    return env, env.brain_names[0]